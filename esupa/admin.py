@@ -12,8 +12,11 @@
 # See the License for the specific language governing permissions and limitations under the License.
 #
 from django.contrib import admin
+from django.utils.timezone import now
+from django.utils.translation import ugettext_lazy, ungettext
 
 from . import models
+from .screening import rescreen
 
 
 def tabular_inlines_of(*children_types):
@@ -33,6 +36,24 @@ class EventAdmin(admin.ModelAdmin):
     list_filter = ('subs_open', 'sales_open')
     inlines = tabular_inlines_of(models.Optional)
     ordering = ('starts_at',)
+    actions = ('rescreen_subscriptions',)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change and 'data_to_be_checked' in form.changed_data:
+            self.rescreen_subscriptions(request, (obj,))
+
+    def rescreen_subscriptions(self, request, queryset):
+        for event in queryset:
+            held = rescreen(event)
+            if held:
+                self.message_user(request, ungettext(
+                    '%(count)d subscription of %(event)s is now held for data checking.',
+                    '%(count)d subscriptions of %(event)s are now held for data checking.',
+                    held) % {'count': held, 'event': event})
+
+    # Translators: This is only displayed in the Django Admin page.
+    rescreen_subscriptions.short_description = ugettext_lazy('Check existing subscriptions against the data to check')
 
 
 class SubscriptionAdmin(admin.ModelAdmin):
@@ -43,5 +64,26 @@ class SubscriptionAdmin(admin.ModelAdmin):
     ordering = ('-id',)
 
 
+class WorkerHeartbeatAdmin(admin.ModelAdmin):
+    list_display = ('name', 'host', 'pid', 'started_at', 'beat_at', 'next_due', 'stopped')
+    readonly_fields = list_display
+
+
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'recipients', 'created_at', 'attempts', 'next_attempt_at', 'sent_at', 'dead')
+    list_filter = ('dead',)
+    readonly_fields = ('dedup_key', 'created_at', 'attempts', 'claimed_by', 'sent_at', 'last_error')
+    ordering = ('-id',)
+    actions = ('retry',)
+
+    def retry(self, request, queryset):
+        queryset.filter(sent_at__isnull=True).update(dead=False, attempts=0, next_attempt_at=now())
+
+    # Translators: This is only displayed in the Django Admin page.
+    retry.short_description = ugettext_lazy('Try sending again')
+
+
 admin.site.register(models.Event, EventAdmin)
 admin.site.register(models.Subscription, SubscriptionAdmin)
+admin.site.register(models.OutboxMessage, OutboxMessageAdmin)
+admin.site.register(models.WorkerHeartbeat, WorkerHeartbeatAdmin)
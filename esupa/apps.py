@@ -12,9 +12,18 @@
 # See the License for the specific language governing permissions and limitations under the License.
 #
 from django.apps import AppConfig
+from django.conf import settings
 from django.utils.translation import ugettext_lazy
 
 
 class EsupaConfig(AppConfig):
     name = __name__[:__name__.rindex('.')]
     verbose_name = ugettext_lazy('esupa - Event Subscription and Payment')
+
+    def ready(self):
+        from . import catalog, notify
+        catalog.connect()
+        notify.connect()
+        if getattr(settings, 'ESUPA_PAYMENT_WARMUP', False):
+            from .payment.base import load_payment_methods
+            load_payment_methods()
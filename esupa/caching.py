@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015, Ekevoo.com.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+#
+"""
+Versioned entries in the shared Django cache, named by ESUPA_CACHE (``'default'`` if unset).
+
+Nothing is ever deleted to invalidate: each entry's key includes the current version of what it was built from,
+so bumping that version makes all of them unreachable at once, in every process, and they simply expire.
+"""
+from time import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+PREFIX = 'esupa:'
+
+
+def get_cache():
+    return caches[getattr(settings, 'ESUPA_CACHE', 'default')]
+
+
+def _fresh_version() -> int:
+    # Starting from the clock, a version that was evicted from the cache is never handed out again.
+    return int(time() * 1000)
+
+
+def get_version(name: str) -> int:
+    """
+    The current version. Should the cache not keep it, like DummyCache, every call gets a new one, which is what
+    not caching at all would do.
+    """
+    cache = get_cache()
+    key = PREFIX + 'version:' + name
+    version = cache.get(key)
+    if version is None:
+        version = _fresh_version()
+        cache.add(key, version, None)
+        version = cache.get(key) or version  # someone else's, if they added theirs first
+    return version
+
+
+def bump_version(name: str):
+    cache = get_cache()
+    key = PREFIX + 'version:' + name
+    try:
+        cache.incr(key)
+    except ValueError:  # not in the cache
+        cache.set(key, _fresh_version(), None)
+
+
+def versioned_key(name: str) -> str:
+    """Key for an entry built from whatever the named version covers."""
+    return '%s%s:v%d' % (PREFIX, name, get_version(name))
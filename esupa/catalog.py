@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015, Ekevoo.com.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+#
+"""
+All events with their optionals, kept in memory by each process because nearly every request needs one and they
+seldom change. Saving or deleting an event or optional anywhere bumps the shared ``catalog`` version (see
+esupa.caching), and each process reloads everything the next time it finds its copy is behind.
+
+That only reaches other processes through a cache they share, such as memcached or Redis; the default
+LocMemCache is per process. Either way, nothing is kept longer than ESUPA_CATALOG_TTL seconds (60 by default).
+
+Callers get their own copy of the event, with occupancy counters that are read from the database on first use,
+since those change all the time without going through ``save()``. The rest may be stale, so copies refuse to be
+saved: fetch the event from the database to change it.
+"""
+from copy import copy
+from time import monotonic
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.utils.timezone import now
+
+from .caching import bump_version, get_version
+from .models import Event, Optional
+
+_catalog = None  # (version, expiry, by slug, by id)
+
+
+def _load() -> tuple:
+    global _catalog
+    version = get_version('catalog')
+    if _catalog is None or _catalog[0] != version or _catalog[1] <= monotonic():
+        events = list(Event.objects.prefetch_related('optional_set'))
+        expiry = monotonic() + getattr(settings, 'ESUPA_CATALOG_TTL', 60)
+        _catalog = (version, expiry, {event.slug: event for event in events}, {event.id: event for event in events})
+    return _catalog
+
+
+def _handout(event: Event) -> Event:
+    if event is None:
+        return None
+    event = copy(event)
+    event.occupancy_stale = event.from_catalog = True
+    return event
+
+
+def event_by_slug(slug: str) -> Event:
+    """The event with this slug, or None."""
+    return _handout(_load()[2].get(slug))
+
+
+def event_by_id(event_id: int) -> Event:
+    """The event with this id, or None."""
+    return _handout(_load()[3].get(event_id))
+
+
+def current_event() -> Event:
+    """The next event to start, or the last one to have started if none is coming. None if there are no events."""
+    events = _load()[3].values()
+    present = now()
+    future = [event for event in events if event.starts_at > present]
+    if future:
+        return _handout(min(future, key=lambda event: event.starts_at))
+    past = [event for event in events if event.starts_at < present]
+    return _handout(max(past, key=lambda event: event.starts_at) if past else None)
+
+
+def invalidate(**kwargs):
+    forget()
+    bump_version('catalog')
+
+
+def forget():
+    """Drops the copy kept by this process only."""
+    global _catalog
+    _catalog = None
+
+
+def connect():
+    """Called once at startup by EsupaConfig.ready()."""
+    for model in (Event, Optional):
+        post_save.connect(invalidate, sender=model, dispatch_uid='esupa.catalog.save.' + model.__name__)
+        post_delete.connect(invalidate, sender=model, dispatch_uid='esupa.catalog.delete.' + model.__name__)
@@ -23,6 +23,7 @@ from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy, ugettext
 
 from .models import Subscription, Optional
+from .storage import validate_receipt_size
 
 log = getLogger(__name__)
 
@@ -138,12 +139,12 @@ class PartialPayForm(forms.Form):
 class ManualTransactionForm(forms.Form):
     amount = forms.DecimalField()
     when = forms.DateTimeField(initial=now)
-    attachment = forms.FileField(required=False)
     notes = forms.CharField(required=False)
+    attachment = forms.FileField(required=False, validators=[validate_receipt_size])  # last, see ReceiptUploadHandler
 
-    def __init__(self, subscription):
+    def __init__(self, subscription, files=None):
         if isinstance(subscription, Subscription):
             super().__init__()
             self.fields['amount'].initial = subscription.get_owing
         else:
-            super().__init__(subscription)
+            super().__init__(subscription, files)
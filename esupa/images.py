@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015, Ekevoo.com.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+#
+"""
+Background processing of uploaded receipts, run by the worker: photos are downscaled to at most
+ESUPA_RECEIPT_IMAGE_SIDE pixels (2000 by default) and recompressed when that makes them smaller, and every image
+gets a thumbnail of ESUPA_RECEIPT_THUMBNAIL_SIDE pixels (200) for the staff pages.
+
+Needs Pillow. Without it, receipts are kept as uploaded and pages show links instead of thumbnails.
+"""
+from io import BytesIO
+from logging import getLogger
+
+from django.conf import settings
+
+from .models import Transaction
+from .storage import delete_unused, open_stored, store
+
+log = getLogger(__name__)
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+    log.info('Pillow is not installed, receipt images will not be processed.')
+
+PROCESSED_TYPES = {'image/jpeg', 'image/pjpeg', 'image/png', 'image/gif', 'image/bmp', 'image/webp', 'image/tiff'}
+
+
+def process_receipts(batch_size=20) -> int:
+    """Processes up to ``batch_size`` receipts uploaded since the last call. Returns how many it went through."""
+    if Image is None:
+        return 0
+    pending = Transaction.objects.filter(document_processed=False).exclude(document_hash='') \
+        .only('id', 'document_hash', 'mimetype').order_by('id')[:batch_size]
+    count = 0
+    for trans in pending:
+        changes = {'document_processed': True}
+        if trans.mimetype in PROCESSED_TYPES:
+            try:
+                changes.update(_process(trans.document_hash))
+            except Exception as e:
+                log.warning('Could not process document of transaction %d: %s', trans.id, e)
+        # Conditional, in case the document was replaced meanwhile or another worker got here first.
+        if Transaction.objects.filter(id=trans.id, document_hash=trans.document_hash).update(**changes):
+            if changes.get('document_hash', trans.document_hash) != trans.document_hash:
+                delete_unused(trans.document_hash)
+        elif 'thumbnail_hash' in changes:
+            delete_unused(changes['thumbnail_hash'])
+            delete_unused(changes.get('document_hash'))
+        count += 1
+    return count
+
+
+def _process(digest: str) -> dict:
+    with open_stored(digest) as document:
+        original_size = document.size
+        image = Image.open(document)
+        image.load()
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    changes = {}
+    side = getattr(settings, 'ESUPA_RECEIPT_IMAGE_SIDE', 2000)
+    image.thumbnail((side, side), Image.LANCZOS)
+    content = _jpeg(image, 85)
+    if len(content) < original_size:
+        changes['document_hash'], changes['document_size'] = store(content)
+        changes['mimetype'] = 'image/jpeg'
+    side = getattr(settings, 'ESUPA_RECEIPT_THUMBNAIL_SIDE', 200)
+    image.thumbnail((side, side), Image.LANCZOS)
+    changes['thumbnail_hash'], _ = store(_jpeg(image, 75))
+    return changes
+
+
+def _jpeg(image, quality: int) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015, Ekevoo.com.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+#
+"""
+Locks that serialize every queue operation on one event.
+
+Each backend is a function that takes an event id and returns a context manager. The context manager opens a
+database transaction and keeps the event locked until that transaction ends. It may be entered again while held.
+Anything that writes to an event or its subscriptions and then touches the queue must take this lock before its
+first write, so the lock, the event row and the subscription rows are always locked in that order. Pick one
+with ESUPA_QUEUE_LOCK:
+
+- ``'row'`` (default): ``SELECT ... FOR UPDATE`` on a dedicated row per event. Works across processes and hosts
+  on any database that supports row locks. SQLite ignores ``FOR UPDATE``, so there it doesn't keep other
+  processes out at all; use ``'thread'`` with a single process instead.
+- ``'advisory'``: PostgreSQL transaction-level advisory locks. No table involved.
+- ``'thread'``: in-process locks only. Good for tests and the single process development server.
+- A dotted path to your own function with the same signature.
+"""
+from contextlib import contextmanager
+from logging import getLogger
+from os import getpid
+from socket import gethostname
+from threading import Lock, RLock
+from time import sleep
+from uuid import uuid4
+from weakref import WeakValueDictionary
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
+
+from .models import EventLock, Lease
+
+log = getLogger(__name__)
+
+ADVISORY_NAMESPACE = 0x65737570  # 'esup', so we don't collide with other users of pg_advisory_xact_lock
+
+_thread_locks = WeakValueDictionary()
+_thread_locks_guard = Lock()
+
+
+@contextmanager
+def thread_lock(event_id):
+    with _thread_locks_guard:
+        lock = _thread_locks.get(event_id)
+        if lock is None:
+            lock = _thread_locks[event_id] = RLock()  # re-entrant, like the database locks
+    with lock, transaction.atomic():  # our reference keeps the lock alive while it's being used
+        yield
+
+
+@contextmanager
+def row_lock(event_id):
+    with transaction.atomic():
+        EventLock.objects.get_or_create(event_id=event_id)
+        list(EventLock.objects.select_for_update().filter(event_id=event_id).values_list('event_id'))
+        yield
+
+
+@contextmanager
+def advisory_lock(event_id):
+    if connection.vendor != 'postgresql':
+        raise ImproperlyConfigured('ESUPA_QUEUE_LOCK = "advisory" requires PostgreSQL, not %s' % connection.vendor)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [ADVISORY_NAMESPACE, event_id])
+        yield
+
+
+backends = {
+    'row': row_lock,
+    'advisory': advisory_lock,
+    'thread': thread_lock,
+}
+
+_backend = None
+
+
+def lock_event(event_id):
+    """Returns a context manager that holds the configured lock for the event, within a transaction."""
+    global _backend
+    if _backend is None:
+        name = getattr(settings, 'ESUPA_QUEUE_LOCK', 'row')
+        _backend = backends[name] if name in backends else import_string(name)
+        log.debug('Using queue lock backend %s', name)
+        if _backend is row_lock and connection.vendor == 'sqlite':
+            log.warning('ESUPA_QUEUE_LOCK = "row" does not lock anything on SQLite; '
+                        'queue operations are only safe within a single process.')
+    return _backend(event_id)
+
+
+class LeaseHeld(Exception):
+    def __init__(self, lease: Lease, *args, **kwargs):
+        self.lease = lease
+        super().__init__(*args, **kwargs)
+
+
+@contextmanager
+def lease(name, ttl):
+    """
+    Holds the named lease while the block runs, or raises LeaseHeld if someone else holds it.
+
+    The lease is taken with a single conditional UPDATE, so this must not run inside a transaction that other
+    processes can't see yet. If the holder dies, the lease is free again once ``ttl`` has passed.
+    """
+    owner = '%s:%d:%s' % (gethostname(), getpid(), uuid4().hex[:8])
+    Lease.objects.get_or_create(name=name)
+    present = now()
+    free = Q(owner='') | Q(expires_at__isnull=True) | Q(expires_at__lte=present)
+    if not Lease.objects.filter(free, name=name).update(owner=owner, acquired_at=present, expires_at=present + ttl):
+        raise LeaseHeld(Lease.objects.get(name=name))
+    try:
+        yield
+    finally:
+        Lease.objects.filter(name=name, owner=owner).update(owner='', released_at=now())
+
+
+def wait_for_lease(name, poll=1.0) -> Lease:
+    """Blocks until nobody holds the named lease, then returns it."""
+    while True:
+        current = Lease.objects.get(name=name)
+        if not current.held:
+            return current
+        sleep(poll)
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015, Ekevoo.com.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+#
+"""
+E-mail delivery by a fixed pool of threads fed through a bounded queue.
+
+Each thread keeps one connection from ``get_connection()`` open while there is mail, and sends everything that is
+waiting, up to ESUPA_MAIL_BATCH messages, over it one by one. When ESUPA_MAIL_QUEUE_SIZE messages are already
+waiting, ``submit()`` blocks until there is room, so a burst of notifications goes at the pace of the mail server
+instead of starting a thread per message. ESUPA_MAIL_WORKERS sets the pool size.
+
+Notifications don't use the pool directly: they're written to the outbox (see OutboxMessage), which
+``deliver_outbox()`` drains from the worker loop, or from the cron view where the worker isn't used.
+"""
+from atexit import register
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from datetime import timedelta
+from logging import getLogger
+from os import getpid
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from time import perf_counter
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db.models import F
+from django.utils.timezone import now
+
+from .models import OutboxMessage
+
+log = getLogger(__name__)
+
+IDLE_SECONDS = 30  # how long a worker keeps its connection open with nothing to send
+
+
+class MailPool:
+    def __init__(self, workers=2, queue_size=1000, batch_size=50, connection_factory=get_connection):
+        self.batch_size = batch_size
+        self._connection_factory = connection_factory
+        self._queue = Queue(queue_size)
+        self._lock = Lock()
+        self._sent = self._failed = self._batches = 0
+        self._latencies = deque(maxlen=1000)  # seconds from submit() to sent, most recent last
+        self._pid = getpid()
+        self._threads = [Thread(target=self._work, name='esupa-mail-%d' % n, daemon=True) for n in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, message, timeout=None) -> Future:
+        """
+        Queues an EmailMessage, blocking while the queue is full. Raises ``queue.Full`` if that takes longer than
+        ``timeout`` seconds. The returned future is done once the message is sent or failed.
+        """
+        future = Future()
+        self._queue.put((message, future, perf_counter()), timeout=timeout)
+        return future
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                'depth': self._queue.qsize(),
+                'sent': self._sent,
+                'failed': self._failed,
+                'batches': self._batches,
+                'latency_median': latencies[len(latencies) // 2] if latencies else None,
+                'latency_max': latencies[-1] if latencies else None,
+            }
+
+    def shutdown(self, timeout=None):
+        """Stops the workers after they send what was already queued."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _work(self):
+        connection = None
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=IDLE_SECONDS if connection else None)
+            except Empty:
+                connection = self._close(connection)
+                continue
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except Empty:
+                    break
+            stopping = item is None
+            if batch:
+                connection = self._send(connection, batch)
+        self._close(connection)
+
+    def _send(self, connection, batch):
+        """
+        Sends the batch one message at a time over the same connection, so each future gets its own outcome and a
+        refused message doesn't fail, and have retried, the ones that went out.
+        """
+        for message, future, queued_at in batch:
+            try:
+                if connection is None:
+                    connection = self._connection_factory()
+                    connection.open()
+                connection.send_messages([message])
+            except Exception as e:
+                log.error('Could not send message to %s', ', '.join(message.recipients()), exc_info=True)
+                with self._lock:
+                    self._failed += 1
+                future.set_exception(e)
+                connection = self._close(connection)  # the next message gets a fresh one
+                continue
+            finished_at = perf_counter()
+            with self._lock:
+                self._sent += 1
+                self._latencies.append(finished_at - queued_at)
+            future.set_result(message)
+        with self._lock:
+            self._batches += 1
+        return connection
+
+    @staticmethod
+    def _close(connection):
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                log.warning('Could not close mail connection', exc_info=True)
+        return None
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_pool() -> MailPool:
+    """The pool of this process, started on first use."""
+    global _pool
+    if _pool is None or _pool._pid != getpid():  # threads don't survive a fork
+        with _pool_lock:
+            if _pool is None or _pool._pid != getpid():
+                _pool = MailPool(workers=getattr(settings, 'ESUPA_MAIL_WORKERS', 2),
+                                 queue_size=getattr(settings, 'ESUPA_MAIL_QUEUE_SIZE', 1000),
+                                 batch_size=getattr(settings, 'ESUPA_MAIL_BATCH', 50))
+    return _pool
+
+
+@register
+def _flush():
+    if _pool is not None and _pool._pid == getpid():
+        _pool.shutdown(timeout=IDLE_SECONDS)
+
+
+def deliver_outbox(batch_size=None) -> int:
+    """
+    Sends up to ``batch_size`` (ESUPA_OUTBOX_BATCH, 200) due messages from the outbox through the pool and
+    returns how many were sent. A failed message is tried again ESUPA_OUTBOX_BACKOFF seconds later (60), twice
+    that after the next failure and so on, up to a day; after ESUPA_OUTBOX_MAX_ATTEMPTS tries (8) it's marked
+    dead and left in the admin. Messages still unsent after ESUPA_OUTBOX_TIMEOUT seconds (120) count as failed,
+    unless the pool was too busy to take them at all; those are simply left for the next call.
+    """
+    batch_size = batch_size or getattr(settings, 'ESUPA_OUTBOX_BATCH', 200)
+    present = now()
+    due = OutboxMessage.pending().filter(next_attempt_at__lte=present)
+    ids = list(due.order_by('next_attempt_at').values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return 0
+    # Moving them out of the due window claims them, so concurrent calls don't send them twice. Should this
+    # process die before finishing, they're due again when the claim runs out.
+    token = uuid4().hex
+    due.filter(id__in=ids).update(claimed_by=token, attempts=F('attempts') + 1,
+                                  next_attempt_at=present + timedelta(minutes=10))
+    pool = get_pool()
+    deadline = perf_counter() + getattr(settings, 'ESUPA_OUTBOX_TIMEOUT', 120)
+    futures = []
+    unsubmitted = []
+    for message in OutboxMessage.objects.filter(claimed_by=token).order_by('id'):
+        try:
+            futures.append((message, pool.submit(_email(message), timeout=max(0, deadline - perf_counter()))))
+        except Full:
+            unsubmitted.append(message.id)
+    if unsubmitted:
+        # Never handed to the mail server, so they don't count as an attempt and are due again right away.
+        log.warning('Mail pool full, leaving %d messages for later', len(unsubmitted))
+        OutboxMessage.objects.filter(id__in=unsubmitted).update(
+            claimed_by='', attempts=F('attempts') - 1, next_attempt_at=present)
+    sent = []
+    backoff = getattr(settings, 'ESUPA_OUTBOX_BACKOFF', 60)
+    max_attempts = getattr(settings, 'ESUPA_OUTBOX_MAX_ATTEMPTS', 8)
+    for message, future in futures:
+        try:
+            error = future.exception(max(0, deadline - perf_counter()))
+        except FutureTimeout:
+            # A hung connection mustn't hold up the caller, the worker loop, forever. Should the message still go
+            # out after this, it will be sent twice; better than not at all. EMAIL_TIMEOUT keeps that rare.
+            error = 'Timed out'
+        if error is None:
+            sent.append(message.id)
+            continue
+        retry_in = timedelta(seconds=min(backoff * 2 ** (message.attempts - 1), 86400))
+        dead = message.attempts >= max_attempts
+        log.warning('Mail #%d to %s failed on attempt %d%s: %s', message.id, message.recipients.replace('\n', ','),
+                    message.attempts, ', giving up' if dead else '', error)
+        OutboxMessage.objects.filter(id=message.id).update(
+            claimed_by='', dead=dead, last_error=str(error), next_attempt_at=now() + retry_in)
+    if sent:
+        OutboxMessage.objects.filter(id__in=sent).update(claimed_by='', sent_at=now(), last_error='')
+    log.info('Delivered %d of %d messages from the outbox', len(sent), len(futures))
+    return len(sent)
+
+
+def _email(message: OutboxMessage) -> EmailMultiAlternatives:
+    email = EmailMultiAlternatives(message.subject, message.body, to=message.recipients.split())
+    if message.html_body:
+        email.attach_alternative(message.html_body, 'text/html')
+    return email
+
+
+def purge_outbox(days=30) -> int:
+    """Forgets messages sent more than that many days ago. Returns how many."""
+    deleted, _ = OutboxMessage.objects.filter(sent_at__lt=now() - timedelta(days=days)).delete()
+    return deleted
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015, Ekevoo.com.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+#
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...models import Transaction
+from ...storage import store
+
+
+class Command(BaseCommand):
+    help = 'Moves documents still kept in the database out to the receipt storage.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Documents loaded into memory at a time.')
+
+    def handle(self, *args, **options):
+        pending = Transaction.objects.filter(document__isnull=False).order_by('id')
+        moved = last_id = 0
+        while True:
+            batch = list(pending.filter(id__gt=last_id).only('id', 'document')[:options['batch_size']])
+            if not batch:
+                break
+            with transaction.atomic():
+                for trans in batch:
+                    # Stored first and cleared after, so an interruption at worst leaves an unreferenced file.
+                    digest, size = store(bytes(trans.document))
+                    Transaction.objects.filter(id=trans.id).update(
+                        document_hash=digest, document_size=size, document=None)
+            moved += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write('Moved %d documents.' % moved)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015, Ekevoo.com.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+#
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, IntegerField, Sum, When
+
+from ...models import Event, SubsState
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the confirmed and pending counters of events from their subscriptions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='*', help='Events to recount. All of them if none given.')
+
+    def handle(self, *args, **options):
+        events = Event.objects.all()
+        if options['slugs']:
+            events = events.filter(slug__in=options['slugs'])
+        for event_id in events.values_list('id', flat=True):
+            with transaction.atomic():
+                # Locking the event row makes concurrent saves wait, so their increments land after our count.
+                event = Event.objects.select_for_update().get(id=event_id)
+                counts = event.subscription_set.aggregate(
+                    confirmed=_count_if(state__gte=SubsState.UNPAID_STAFF),
+                    pending=_count_if(state__gt=SubsState.ACCEPTABLE, state__lt=SubsState.UNPAID_STAFF))
+                confirmed, pending = counts['confirmed'] or 0, counts['pending'] or 0
+                if (confirmed, pending) != (event.confirmed_count, event.pending_count):
+                    self.stdout.write('%s: confirmed %d -> %d, pending %d -> %d' % (
+                        event.slug, event.confirmed_count, confirmed, event.pending_count, pending))
+                    Event.objects.filter(id=event_id).update(confirmed_count=confirmed, pending_count=pending)
+                    event.public_state_changed()
+
+
+def _count_if(**criteria):
+    return Sum(Case(When(then=1, **criteria), default=0, output_field=IntegerField()))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015, Ekevoo.com.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+#
+from django.core.management.base import BaseCommand
+
+from ...models import Event
+from ...screening import rescreen
+
+
+class Command(BaseCommand):
+    help = "Holds existing subscriptions that match their event's data to be checked."
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='*', help='Events to screen. All of them if none given.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Subscriptions read per query.')
+
+    def handle(self, *args, **options):
+        events = Event.objects.exclude(data_to_be_checked='')
+        if options['slugs']:
+            events = events.filter(slug__in=options['slugs'])
+        for event in events:
+            held = rescreen(event, options['batch_size'])
+            self.stdout.write('%s: %d held.' % (event.slug, held))
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015, Ekevoo.com.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+#
+from datetime import timedelta
+from logging import getLogger
+from os import getpid
+from signal import signal, SIGINT, SIGTERM
+from socket import gethostname
+from threading import Event
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils.timezone import now
+
+from ...images import process_receipts
+from ...mailer import deliver_outbox, purge_outbox
+from ...models import Deadline, OutboxMessage, WorkerHeartbeat
+from ...notify import flush_staff_digests, next_digest_due
+from ...queue import single_flight_cron
+from ...storage import purge_orphans
+
+log = getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Keeps queues, toggles and notifications up to date, sleeping until the next deadline is due.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', default='esupa_worker',
+                            help='Heartbeat record name. Give each worker its own.')
+        parser.add_argument('--max-sleep', type=float, default=60,
+                            help='Longest nap between loops, in seconds, even when nothing is due.')
+        parser.add_argument('--full-sweep', type=float, default=3600,
+                            help='Seconds between sweeps of every event, even those without changes. Zero disables.')
+        parser.add_argument('--receipt-batch', type=int, default=20,
+                            help='Receipt images processed per loop. See esupa.images.')
+        parser.add_argument('--once', action='store_true',
+                            help='Run a single loop and exit.')
+
+    def handle(self, *args, **options):
+        stopping = Event()
+
+        def stop(signum, _):
+            log.info('Got signal %d, stopping after this loop.', signum)
+            stopping.set()
+
+        signal(SIGINT, stop)
+        signal(SIGTERM, stop)
+        started_at = now()
+        heartbeat = WorkerHeartbeat(name=options['name'], host=gethostname(), pid=getpid(), started_at=started_at)
+        full_sweep = timedelta(seconds=options['full_sweep'])
+        workers = getattr(settings, 'ESUPA_CRON_WORKERS', 1)  # processes sweeping events in parallel
+        last_full_sweep = None
+        log.info('Worker %s started.', heartbeat.name)
+        failures = 0
+        while not stopping.is_set():
+            close_old_connections()
+            self.failed = False
+            present = now()
+            everything = bool(full_sweep) and (last_full_sweep is None or last_full_sweep + full_sweep <= present)
+            if self.step(single_flight_cron, everything=everything, workers=workers) is not None and everything:
+                last_full_sweep = present
+                self.step(purge_outbox)
+            processed = self.step(process_receipts, options['receipt_batch'])
+            backlog = processed is not None and processed >= options['receipt_batch']
+            self.step(purge_orphans)
+            self.step(flush_staff_digests)
+            self.step(deliver_outbox)
+            self.step(self.beat, heartbeat)
+            if options['once']:
+                break
+            nap = options['max_sleep']
+            if self.failed:
+                # Whatever broke may take a while to come back, e.g. the database, so don't hammer it meanwhile.
+                failures += 1
+                nap = min(nap, 2 ** failures)
+            else:
+                failures = 0
+                if backlog:
+                    nap = 0
+                elif heartbeat.next_due is not None:
+                    nap = min(nap, max(0, (heartbeat.next_due - now()).total_seconds()))
+            stopping.wait(nap)
+        heartbeat.stopped = True
+        self.step(heartbeat.save)
+        close_old_connections()
+        log.info('Worker %s stopped.', heartbeat.name)
+
+    failed = False
+
+    def step(self, function, *args, **kwargs):
+        """Runs one step of the loop. Should it fail, logs why and returns None, so the next step still runs."""
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            log.exception('Worker step %s failed.', function.__name__)
+            self.failed = True
+            close_old_connections()  # a broken connection is replaced instead of failing every step after this
+            return None
+
+    @staticmethod
+    def beat(heartbeat: WorkerHeartbeat):
+        heartbeat.next_due = min(filter(None, (Deadline.next_due(), OutboxMessage.next_due(), next_digest_due())),
+                                 default=None)
+        heartbeat.beat_at = now()
+        heartbeat.save()
+        return heartbeat
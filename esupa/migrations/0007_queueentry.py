@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from json import loads
+
+from django.db import migrations, models
+
+
+def forwards(apps, schema_editor):
+    QueueContainer = apps.get_model('esupa', 'QueueContainer')
+    QueueEntry = apps.get_model('esupa', 'QueueEntry')
+    Subscription = apps.get_model('esupa', 'Subscription')
+    for qc in QueueContainer.objects.all():
+        queue = loads(qc.data)
+        existing = set(Subscription.objects.filter(event_id=qc.event_id, id__in=queue).values_list('id', flat=True))
+        seen = set()
+        entries = []
+        for sid in queue:
+            if sid in existing and sid not in seen:
+                seen.add(sid)
+                entries.append(QueueEntry(event_id=qc.event_id, subscription_id=sid))
+        QueueEntry.objects.bulk_create(entries)  # ids are assigned in list order, which keeps queue order
+
+
+def backwards(apps, schema_editor):
+    from json import dumps
+
+    QueueContainer = apps.get_model('esupa', 'QueueContainer')
+    QueueEntry = apps.get_model('esupa', 'QueueEntry')
+    queues = {}
+    for event_id, sid in QueueEntry.objects.order_by('id').values_list('event_id', 'subscription_id'):
+        queues.setdefault(event_id, []).append(sid)
+    for event_id, queue in queues.items():
+        QueueContainer.objects.update_or_create(event_id=event_id, defaults={'data': dumps(queue)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esupa', '0006_partial_payment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, verbose_name='ID', primary_key=True, serialize=False)),
+                ('event', models.ForeignKey(to='esupa.Event')),
+                ('subscription', models.OneToOneField(to='esupa.Subscription')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='queueentry',
+            index_together=set([('event', 'id')]),
+        ),
+        migrations.RunPython(forwards, backwards),
+        migrations.DeleteModel(
+            name='QueueContainer',
+        ),
+    ]
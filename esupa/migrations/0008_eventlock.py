@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esupa', '0007_queueentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventLock',
+            fields=[
+                ('event', models.OneToOneField(serialize=False, to='esupa.Event', primary_key=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def forwards(apps, schema_editor):
+    Event = apps.get_model('esupa', 'Event')
+    Subscription = apps.get_model('esupa', 'Subscription')
+    Deadline = apps.get_model('esupa', 'Deadline')
+    deadlines = []
+    for event in Event.objects.all():
+        for kind, when in ((2, event.subs_toggle), (3, event.sales_toggle), (4, event.partial_payment_toggle)):
+            if when:
+                deadlines.append(Deadline(event=event, kind=kind, due_at=when))
+    for subscription in Subscription.objects.filter(state=55, wait_until__isnull=False):
+        deadlines.append(Deadline(event_id=subscription.event_id, subscription=subscription,
+                                  kind=1, due_at=subscription.wait_until))
+    Deadline.objects.bulk_create(deadlines)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esupa', '0008_eventlock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Deadline',
+            fields=[
+                ('id', models.AutoField(auto_created=True, verbose_name='ID', primary_key=True, serialize=False)),
+                ('kind', models.SmallIntegerField(choices=[(1, 'Payment wait'), (2, 'Subscriptions toggle'), (3, 'Sales toggle'), (4, 'Partial payments toggle')])),
+                ('due_at', models.DateTimeField(db_index=True)),
+                ('event', models.ForeignKey(to='esupa.Event')),
+                ('subscription', models.ForeignKey(blank=True, null=True, to='esupa.Subscription')),
+            ],
+            options={
+                'ordering': ('due_at',),
+            },
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esupa', '0009_deadline'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkerHeartbeat',
+            fields=[
+                ('name', models.CharField(max_length=100, serialize=False, primary_key=True)),
+                ('host', models.CharField(max_length=255)),
+                ('pid', models.IntegerField()),
+                ('started_at', models.DateTimeField()),
+                ('beat_at', models.DateTimeField()),
+                ('next_due', models.DateTimeField(null=True, blank=True)),
+                ('stopped', models.BooleanField(default=False)),
+            ],
+        ),
+    ]
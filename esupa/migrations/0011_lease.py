@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esupa', '0010_workerheartbeat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lease',
+            fields=[
+                ('name', models.CharField(max_length=50, serialize=False, primary_key=True)),
+                ('owner', models.CharField(max_length=100, blank=True)),
+                ('acquired_at', models.DateTimeField(null=True, blank=True)),
+                ('expires_at', models.DateTimeField(null=True, blank=True)),
+                ('released_at', models.DateTimeField(null=True, blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def forwards(apps, schema_editor):
+    Event = apps.get_model('esupa', 'Event')
+    Deadline = apps.get_model('esupa', 'Deadline')
+    for row in Deadline.objects.values('event_id').annotate(next_deadline=Min('due_at')):
+        Event.objects.filter(id=row['event_id']).update(next_deadline=row['next_deadline'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esupa', '0011_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='needs_sweep',
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='next_deadline',
+            field=models.DateTimeField(null=True, blank=True, editable=False, db_index=True),
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
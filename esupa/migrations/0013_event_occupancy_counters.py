@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def forwards(apps, schema_editor):
+    Event = apps.get_model('esupa', 'Event')
+    for event in Event.objects.all():
+        subscriptions = event.subscription_set
+        Event.objects.filter(id=event.id).update(
+            confirmed_count=subscriptions.filter(state__gte=88).count(),
+            pending_count=subscriptions.filter(state__gt=11, state__lt=88).count())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esupa', '0012_event_sweep_tracking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='confirmed_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='pending_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
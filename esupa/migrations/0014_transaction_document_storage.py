@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esupa', '0013_event_occupancy_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='document_hash',
+            field=models.CharField(max_length=64, blank=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='document_size',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+    ]
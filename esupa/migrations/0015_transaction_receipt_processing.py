@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esupa', '0014_transaction_document_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='document_processed',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='thumbnail_hash',
+            field=models.CharField(max_length=64, blank=True),
+        ),
+    ]
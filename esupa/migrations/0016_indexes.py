@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count
+
+# Partial indexes, for the databases that have them. Others make do with the composite ones.
+PARTIAL_INDEXES = (
+    ('esupa_subscription_queued', 'esupa_subscription', '(event_id, position, id)', 'position IS NOT NULL'),
+    ('esupa_transaction_pending', 'esupa_transaction', '(subscription_id, method)', 'ended_at IS NULL'),
+)
+PARTIAL_INDEX_VENDORS = ('postgresql', 'sqlite')
+
+
+def check_duplicates(apps, schema_editor):
+    Subscription = apps.get_model('esupa', 'Subscription')
+    duplicates = Subscription.objects.filter(user__isnull=False).values('event_id', 'user_id') \
+        .annotate(count=Count('id')).filter(count__gt=1)
+    if duplicates:
+        raise RuntimeError('Users with more than one subscription to the same event must be merged first: %s' %
+                           ', '.join('event %(event_id)d user %(user_id)d' % row for row in duplicates))
+
+
+def create_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor in PARTIAL_INDEX_VENDORS:
+        for name, table, columns, condition in PARTIAL_INDEXES:
+            schema_editor.execute('CREATE INDEX %s ON %s %s WHERE %s' % (name, table, columns, condition))
+
+
+def drop_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor in PARTIAL_INDEX_VENDORS:
+        for name, table, columns, condition in PARTIAL_INDEXES:
+            schema_editor.execute('DROP INDEX %s' % name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esupa', '0015_transaction_receipt_processing'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='subscription',
+            unique_together=set([('event', 'user')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='subscription',
+            index_together=set([('event', 'state')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='transaction',
+            index_together=set([('method', 'remote_identifier'), ('subscription', 'accepted', 'ended_at')]),
+        ),
+        migrations.RunPython(create_partial_indexes, drop_partial_indexes),
+    ]
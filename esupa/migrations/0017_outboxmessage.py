@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esupa', '0016_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('recipients', models.TextField()),
+                ('subject', models.CharField(max_length=255)),
+                ('body', models.TextField()),
+                ('dedup_key', models.CharField(max_length=100, unique=True, null=True, blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('attempts', models.SmallIntegerField(default=0)),
+                ('claimed_by', models.CharField(max_length=32, blank=True, db_index=True)),
+                ('sent_at', models.DateTimeField(null=True, blank=True)),
+                ('dead', models.BooleanField(default=False)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='outboxmessage',
+            index_together=set([('sent_at', 'dead', 'next_attempt_at')]),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esupa', '0017_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StaffDigestItem',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=20)),
+                ('text', models.TextField()),
+                ('link', models.CharField(max_length=255, blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('event', models.ForeignKey(to='esupa.Event')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+    ]
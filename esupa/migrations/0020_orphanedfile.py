@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esupa', '0019_outboxmessage_html_body'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrphanedFile',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('since', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -11,15 +11,19 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 #
+from collections import OrderedDict
 from datetime import date, timedelta
 from decimal import Decimal
+from io import BytesIO
 from logging import getLogger
 
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
 from django.utils.timezone import now
-from django.utils.translation import ugettext_lazy, ugettext
+from django.utils.translation import get_language, ugettext_lazy, ugettext
+
+from .caching import bump_version
 
 log = getLogger(__name__)
 decimal_zero = Decimal('0.00')
@@ -38,7 +42,37 @@ def slug_blacklist_validator(target):
                               ', '.join(slug_blacklist))
 
 
-class Enum:
+class EnumType(type):
+    """Indexes the choices of each Enum as it's declared, and makes one immutable member per choice."""
+
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault('__slots__', ())  # so subclasses don't get a __dict__ either
+        return super().__new__(mcs, name, bases, namespace)
+
+    def __init__(cls, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        cls._members = OrderedDict()
+        cls._labels = {}  # language -> label -> value, filled as needed since labels are lazy translations
+        for (value, descr) in cls.choices:
+            member = object.__new__(cls)
+            object.__setattr__(member, '_value', value)
+            object.__setattr__(member, '_descr', descr)
+            cls._members[value] = member
+
+    def _value_of_label(cls, label):
+        language = get_language()
+        labels = cls._labels.get(language)
+        if labels is None:
+            labels = cls._labels[language] = {str(descr): value for (value, descr) in cls.choices}
+        return labels.get(str(label))
+
+
+class Enum(metaclass=EnumType):
+    """
+    Integer choices with their descriptions. Calling the class gives the member of a value or description (the
+    first one if neither), always the same instance, while the class attributes stay plain ints for queries.
+    """
+    __slots__ = ('_value', '_descr')
     choices = ()
 
     @classmethod
@@ -48,20 +82,36 @@ class Enum:
 
     @classmethod
     def get(cls, value):
-        for (key, desc) in cls.choices:
-            if key == value:
-                return desc
-            elif desc == value:
-                return key
-
-    def __init__(self, value=None):
-        for row in type(self).choices:
-            if value is None or value in row:
-                self._value = row[0]
-                self._descr = row[1]
-                return
+        member = cls._members.get(value) if isinstance(value, int) else None
+        if member is not None:
+            return member._descr
+        return cls._value_of_label(value)
+
+    def __new__(cls, value=None):
+        if value is None:
+            if cls._members:
+                return next(iter(cls._members.values()))
+        elif isinstance(value, int):
+            if value in cls._members:
+                return cls._members[value]
+        else:
+            value = cls._value_of_label(value)
+            if value is not None:
+                return cls._members[value]
         raise ValueError()
 
+    def __setattr__(self, name, value):
+        raise AttributeError('%s members are immutable.' % type(self).__name__)
+
+    def __reduce__(self):
+        return type(self), (self._value,)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
     def __str__(self):
         return str(self._descr)
 
@@ -102,6 +152,30 @@ class SubsState(Enum):
     )
 
 
+class DeadlineKind(Enum):
+    PAYMENT = 1
+    SUBSCRIPTIONS = 2
+    SALES = 3
+    PARTIAL_PAYMENT = 4
+    # Translators: These are the kinds of scheduled deadlines, only displayed in the Django Admin page.
+    choices = (
+        (PAYMENT, ugettext_lazy('Payment wait')),
+        (SUBSCRIPTIONS, ugettext_lazy('Subscriptions toggle')),
+        (SALES, ugettext_lazy('Sales toggle')),
+        (PARTIAL_PAYMENT, ugettext_lazy('Partial payments toggle')),
+    )
+
+
+def _occupancy(state) -> tuple:
+    """Whether a subscription in this state counts as (confirmed, pending)."""
+    if state is None or state <= SubsState.ACCEPTABLE:
+        return 0, 0
+    elif state < SubsState.UNPAID_STAFF:
+        return 0, 1
+    else:
+        return 1, 0
+
+
 class Event(models.Model):
     name = models.CharField(max_length=20)
     slug = models.SlugField(validators=[slug_blacklist_validator], unique=True)
@@ -120,25 +194,118 @@ class Event(models.Model):
     deposit_info = models.TextField(blank=True)
     payment_wait_hours = models.IntegerField(default=48)
     data_to_be_checked = models.TextField(blank=True)
+    # Kept up to date by the models below, so cron can skip events with nothing to do.
+    needs_sweep = models.BooleanField(default=True, editable=False)
+    next_deadline = models.DateTimeField(null=True, blank=True, editable=False, db_index=True)
+    # Kept up to date by Subscription, so availability can be read without counting. See esupa_recount.
+    confirmed_count = models.IntegerField(default=0, editable=False)
+    pending_count = models.IntegerField(default=0, editable=False)
+
+    # Only ever written with UPDATE statements, so a stale instance won't overwrite them when saved.
+    MAINTAINED_FIELDS = {'needs_sweep', 'next_deadline', 'confirmed_count', 'pending_count'}
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if self.from_catalog:
+            raise ValueError('Event %d came from the catalog and may be stale. Fetch it to save it.' % self.pk)
+        if self.pk and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.MAINTAINED_FIELDS]
+        result = super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or Deadline.TOGGLE_FIELDS.intersection(update_fields):
+            Deadline.schedule_toggles(self)
+        self.mark_for_sweep(self.id)
+        self.needs_sweep = True
+        self.public_state_changed()
+        return result
+
+    @staticmethod
+    def mark_for_sweep(event_id):
+        Event.objects.filter(id=event_id).update(needs_sweep=True)
+
+    _stats = None
+
+    @property
+    def stats(self):
+        if self._stats is None:
+            self.load_stats((self,))
+        return self._stats
+
+    @staticmethod
+    def load_stats(events) -> list:
+        """Fills in the stats of many events at once, with two grouped queries in total. Returns them as a list."""
+        events = list(events)
+        by_id = {event.id: event for event in events}
+        for event in events:
+            event._stats = EventStats(event)
+        subscriptions = Subscription.objects.filter(event_id__in=by_id).values('event_id', 'state')
+        for row in subscriptions.annotate(
+                count=models.Count('id', distinct=True),
+                paid=models.Sum(models.Case(
+                    models.When(transaction__accepted=True, transaction__ended_at__isnull=False,
+                                then='transaction__amount'),
+                    output_field=models.DecimalField()))):
+            by_id[row['event_id']]._stats.add(row['state'], count=row['count'], paid=row['paid'])
+        for row in subscriptions.annotate(optionals=models.Sum('optionals__price')).filter(optionals__gt=0):
+            by_id[row['event_id']]._stats.add(row['state'], optionals=row['optionals'])
+        return events
+
     def current_subscription_stats(self):
-        sfilter = self.subscription_set.filter
-        return map(lambda tu: sfilter(state=tu[0]).count(), SubsState.choices)
+        return self.stats.counts
+
+    @staticmethod
+    def shift_occupancy(event_id, transitions) -> bool:
+        """
+        Applies the net change in counters caused by subscriptions moving from one state to another, given as
+        (old, new) pairs, with one UPDATE. Use within the transaction that saves the states. Returns if it changed.
+        """
+        confirmed = pending = 0
+        for old_state, new_state in transitions:
+            old_confirmed, old_pending = _occupancy(old_state)
+            new_confirmed, new_pending = _occupancy(new_state)
+            confirmed += new_confirmed - old_confirmed
+            pending += new_pending - old_pending
+        if confirmed or pending:
+            Event.objects.filter(id=event_id).update(confirmed_count=models.F('confirmed_count') + confirmed,
+                                                     pending_count=models.F('pending_count') + pending)
+            return True
+        else:
+            return False
+
+    occupancy_stale = False  # set on instances handed out by esupa.catalog, to read the counters when needed
+    from_catalog = False  # set on those same instances, which must not be saved
+
+    def refresh_occupancy(self):
+        self.refresh_from_db(fields=('confirmed_count', 'pending_count'))
+        self.occupancy_stale = False
+
+    def _counters(self) -> tuple:
+        if self.occupancy_stale:
+            self.refresh_occupancy()
+        return self.confirmed_count, self.pending_count
+
+    def public_state_changed(self):
+        """Makes the cached public availability stale. See views.json_state."""
+        bump_version('json-state:' + self.slug)
 
     @property
     def num_confirmed(self):
-        return self.subscription_set.filter(state__gte=SubsState.UNPAID_STAFF).count()
+        return self._counters()[0]
 
     @property
     def num_pending(self):
-        return self.subscription_set.filter(state__lt=SubsState.UNPAID_STAFF, state__gt=SubsState.ACCEPTABLE).count()
+        return self._counters()[1]
+
+    @property
+    def num_occupied(self):
+        return sum(self._counters())
 
     @property
     def num_openings(self):
-        return self.capacity - self.subscription_set.filter(state__gt=SubsState.ACCEPTABLE).count()
+        return self.capacity - self.num_occupied
 
     @property
     def max_born(self):
@@ -165,10 +332,67 @@ class Event(models.Model):
 
     def check_occupancy(self):
         if self.sales_open and self.num_openings <= 0:
-            self.sales_open = False
-            self.save()
-            from .notify import EventNotifier
-            EventNotifier(self).sales_closed()
+            with transaction.atomic():
+                # Written from a fresh copy, since this one may have come from the catalog.
+                event = Event.objects.select_for_update().get(id=self.id)
+                self.sales_open = False
+                if not event.sales_open:
+                    return  # someone else just closed them
+                event.sales_open = False
+                event.save()
+                from .notify import EventNotifier
+                EventNotifier(event).sales_closed()
+
+
+def _money(value) -> Decimal:
+    """Aggregates come back as floats from some databases."""
+    return Decimal(str(value or 0)).quantize(decimal_zero)
+
+
+class EventStats:
+    """Subscription counts per state and money of one event. See Event.load_stats()."""
+
+    def __init__(self, event: Event):
+        self.event = event
+        self.by_state = OrderedDict((key, 0) for key, _ in SubsState.choices)
+        self._paid = {}
+        self._optionals = {}
+
+    def add(self, state, count=0, paid=None, optionals=None):
+        self.by_state[state] += count
+        self._paid[state] = self._paid.get(state, decimal_zero) + _money(paid)
+        self._optionals[state] = self._optionals.get(state, decimal_zero) + _money(optionals)
+
+    @property
+    def counts(self) -> list:
+        return list(self.by_state.values())
+
+    @property
+    def confirmed(self) -> int:
+        return sum(n for state, n in self.by_state.items() if _occupancy(state)[0])
+
+    @property
+    def pending(self) -> int:
+        return sum(n for state, n in self.by_state.items() if _occupancy(state)[1])
+
+    @property
+    def openings(self) -> int:
+        return self.event.capacity - self.confirmed - self.pending
+
+    @property
+    def collected(self) -> Decimal:
+        """Everything accepted, from subscriptions in any state."""
+        return sum(self._paid.values(), decimal_zero)
+
+    @property
+    def owed(self) -> Decimal:
+        """What confirmed and pending subscriptions still have to pay."""
+        owed = decimal_zero
+        for state, count in self.by_state.items():
+            if any(_occupancy(state)):
+                owed += self.event.price * count + self._optionals.get(state, decimal_zero)
+                owed -= self._paid.get(state, decimal_zero)
+        return owed
 
 
 class Optional(models.Model):
@@ -180,9 +404,37 @@ class Optional(models.Model):
         return self.name
 
 
-class QueueContainer(models.Model):
-    event = models.OneToOneField(Event, primary_key=True)
-    data = models.TextField(default='[]')  # only because we're using json
+class SubscriptionQuerySet(models.QuerySet):
+    def with_financials(self):
+        """
+        Computes price, paid, paid_any and owing of every subscription in the same SQL statement that loads them,
+        with correlated subqueries, so the properties of the same names don't have to query anything.
+        """
+        qn = connection.ops.quote_name
+        subscription = qn(Subscription._meta.db_table)
+        optionals = Subscription._meta.get_field('optionals')
+        price = ('(SELECT e.%(price)s FROM %(event)s e WHERE e.%(id)s = %(subscription)s.%(event_id)s)'
+                 ' + COALESCE((SELECT SUM(o.%(price)s) FROM %(optional)s o'
+                 ' INNER JOIN %(m2m)s so ON so.%(optional_id)s = o.%(id)s'
+                 ' WHERE so.%(subscription_id)s = %(subscription)s.%(id)s), 0)') % {
+            'price': qn('price'), 'id': qn('id'), 'event_id': qn('event_id'), 'subscription': subscription,
+            'event': qn(Event._meta.db_table), 'optional': qn(Optional._meta.db_table),
+            'm2m': qn(optionals.m2m_db_table()), 'optional_id': qn(optionals.m2m_reverse_name()),
+            'subscription_id': qn(optionals.m2m_column_name())}
+        accepted = ('FROM %(transaction)s t WHERE t.%(subscription_id)s = %(subscription)s.%(id)s'
+                    ' AND t.%(accepted)s = %%s AND t.%(ended_at)s IS NOT NULL') % {
+            'transaction': qn(Transaction._meta.db_table), 'subscription_id': qn('subscription_id'),
+            'subscription': subscription, 'id': qn('id'), 'accepted': qn('accepted'), 'ended_at': qn('ended_at')}
+        paid = 'COALESCE((SELECT SUM(t.%s) %s), 0)' % (qn('amount'), accepted)
+        paid_any = 'EXISTS(SELECT 1 %s AND t.%s > 0)' % (accepted, qn('amount'))
+        return self.extra(
+            select=OrderedDict((
+                ('annotated_price', price),
+                ('annotated_paid', paid),
+                ('annotated_paid_any', paid_any),
+                ('annotated_owing', '%s - %s' % (price, paid)),
+            )),
+            select_params=(True, True, True))
 
 
 class Subscription(models.Model):
@@ -206,6 +458,13 @@ class Subscription(models.Model):
     agreed = models.BooleanField(default=False)
     position = models.IntegerField(null=True, blank=True)
 
+    objects = SubscriptionQuerySet.as_manager()
+
+    class Meta:
+        # Migration 0016 adds a partial index on queued subscriptions, which Django can't declare here.
+        unique_together = (('event', 'user'),)
+        index_together = (('event', 'state'),)
+
     def __str__(self):
         return self.badge
 
@@ -216,11 +475,41 @@ class Subscription(models.Model):
         else:
             return False
 
+    def _locked_state(self):
+        """
+        The state as it is in the database, locking the row until the transaction ends, so the event counters
+        are shifted from what was really there, even if this instance is stale or someone else is saving it too.
+        """
+        if self.pk is None:
+            return None
+        return Subscription.objects.select_for_update().filter(pk=self.pk).values_list('state', flat=True).first()
+
     def save(self, *args, **kwargs):
-        result = super().save(*args, **kwargs)
+        from .locks import lock_event
+        update_fields = kwargs.get('update_fields')
+        with lock_event(self.event_id):  # before the rows below, in the same order as the sweep
+            old_state = self._locked_state()
+            result = super().save(*args, **kwargs)
+            new_state = self.state if update_fields is None or 'state' in update_fields else old_state
+            shifted = Event.shift_occupancy(self.event_id, ((old_state, new_state),))
+            Deadline.schedule_payment(self)
+            Event.mark_for_sweep(self.event_id)
+        if shifted:
+            self.event.refresh_occupancy()
+            self.event.public_state_changed()
         self.event.check_occupancy()
         return result
 
+    def delete(self, *args, **kwargs):
+        from .locks import lock_event
+        with lock_event(self.event_id):
+            old_state = self._locked_state()
+            result = super().delete(*args, **kwargs)
+            shifted = Event.shift_occupancy(self.event_id, ((old_state, None),))
+        if shifted:
+            self.event.public_state_changed()
+        return result
+
     @property
     def waiting(self) -> bool:
         return False if self.wait_until is None else self.wait_until > now()
@@ -234,18 +523,26 @@ class Subscription(models.Model):
 
     @property
     def price(self) -> Decimal:
+        if hasattr(self, 'annotated_price'):
+            return _money(self.annotated_price)
         return self.event.price + (self.optionals.aggregate(models.Sum('price'))['price__sum'] or decimal_zero)
 
     @property
     def paid(self) -> Decimal:
+        if hasattr(self, 'annotated_paid'):
+            return _money(self.annotated_paid)
         return self.transaction_set.filter(accepted=True, ended_at__isnull=False) \
                    .aggregate(models.Sum('amount'))['amount__sum'] or decimal_zero
 
     @property
     def paid_any(self) -> bool:
+        if hasattr(self, 'annotated_paid_any'):
+            return bool(self.annotated_paid_any)
         return self.transaction_set.filter(accepted=True, ended_at__isnull=False, amount__gt=0).exists()
 
     def get_owing(self) -> Decimal:
+        if hasattr(self, 'annotated_owing'):
+            return _money(self.annotated_owing)
         return self.price - self.paid
 
     @property
@@ -271,19 +568,38 @@ class Transaction(models.Model):
     method = models.SmallIntegerField(default=0)
     remote_identifier = models.CharField(max_length=50, blank=True)
     mimetype = models.CharField(max_length=255, blank=True)
-    document = models.BinaryField(null=True)
+    document = models.BinaryField(null=True)  # legacy, see esupa_move_receipts
+    document_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    document_size = models.IntegerField(null=True, blank=True)
+    document_processed = models.BooleanField(default=False, editable=False)  # see esupa.images
+    thumbnail_hash = models.CharField(max_length=64, blank=True)
     filled_at = models.DateTimeField(null=True, blank=True)
     verifier = models.ForeignKey(User, blank=True, null=True)
     accepted = models.BooleanField(default=False)
     notes = models.TextField(blank=True)
     ended_at = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        # Migration 0016 adds a partial index on pending transactions, which Django can't declare here.
+        index_together = (('method', 'remote_identifier'), ('subscription', 'accepted', 'ended_at'))
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        Event.objects.filter(subscription__id=self.subscription_id).update(needs_sweep=True)
+        return result
+
     def end(self, sucessfully) -> bool:
         """
-        Closes a transaction, and will propagate the appropriate changes to the belonging subscription.
+        Closes a transaction, and will propagate the appropriate changes to the belonging subscription. All of it
+        is written in a single database transaction, under the event's queue lock.
         :param bool sucessfully: Whether the transaction is ending successfully or not.
         :return bool: Whether the state of the subscription was changed.
         """
+        from .locks import lock_event
+        with lock_event(self.subscription.event_id):
+            return self._end(sucessfully)
+
+    def _end(self, sucessfully) -> bool:
         self.accepted = sucessfully
         if not self.ended_at:
             self.ended_at = now()
@@ -312,10 +628,234 @@ class Transaction(models.Model):
             subscription.position = None
             subscription.waiting = False
             subscription.save()
+            from .queue import QueueAgent
+            QueueAgent(subscription).remove()  # frees the seat for whoever is next
             return True
 
+    @property
+    def has_document(self) -> bool:
+        return bool(self.document_hash) or self.document is not None
+
+    def attach_document(self, chunks, mimetype: str):
+        """
+        Stores the content, given piece by piece as in ``UploadedFile.chunks()``, out of the database and keeps
+        only its metadata here. Raises ReceiptTooLarge past the size limit. Doesn't save.
+        """
+        from .storage import store_chunks
+        self.document_hash, self.document_size = store_chunks(chunks)
+        self.mimetype = mimetype
+        self.document = None
+        self.document_processed = False
+        self.thumbnail_hash = ''
+
+    def open_document(self):
+        """A binary file with the document, wherever it is; or None if there isn't one."""
+        if self.document_hash:
+            from .storage import open_stored
+            return open_stored(self.document_hash)
+        elif self.document is not None:
+            return BytesIO(self.document)
+
     @property
     def str_method(self):
         from .payment.base import get_payment_names
 
         return get_payment_names().get(int(self.method))
+
+
+class QueueEntry(models.Model):
+    """
+    One row per queued subscription. The auto-incrementing id is the ordering key, so a subscription's
+    position is simply how many entries of the same event have a lower id.
+    """
+    event = models.ForeignKey(Event)
+    subscription = models.OneToOneField(Subscription)
+
+    class Meta:
+        index_together = (('event', 'id'),)
+        ordering = ('id',)
+
+    def __str__(self):
+        return '%d@%d' % (self.subscription_id, self.event_id)
+
+
+class EventLock(models.Model):
+    """Row that is locked with SELECT FOR UPDATE to serialize queue operations. See the locks module."""
+    event = models.OneToOneField(Event, primary_key=True)
+
+
+class Deadline(models.Model):
+    """
+    Persistent schedule of every moment when an event needs attention: payment waits expiring and toggles coming
+    due. It's indexed by due_at, so finding the next one to act upon never requires going through every event.
+    """
+    event = models.ForeignKey(Event)
+    subscription = models.ForeignKey(Subscription, null=True, blank=True)
+    kind = DeadlineKind.field()
+    due_at = models.DateTimeField(db_index=True)
+
+    TOGGLE_FIELDS = {'subs_toggle', 'sales_toggle', 'partial_payment_toggle'}
+
+    class Meta:
+        ordering = ('due_at',)
+
+    def __str__(self):
+        return '%s %s' % (DeadlineKind(self.kind), self.due_at)
+
+    @classmethod
+    def schedule_toggles(cls, event: Event):
+        cls.objects.filter(event=event, subscription__isnull=True).delete()
+        cls.objects.bulk_create(cls(event=event, kind=kind, due_at=when) for kind, when in (
+            (DeadlineKind.SUBSCRIPTIONS, event.subs_toggle),
+            (DeadlineKind.SALES, event.sales_toggle),
+            (DeadlineKind.PARTIAL_PAYMENT, event.partial_payment_toggle),
+        ) if when)
+        event.next_deadline = cls._update_next_deadline(event.id)
+
+    @classmethod
+    def schedule_payment(cls, subscription: Subscription):
+        scheduled = cls.objects.filter(subscription=subscription)
+        expecting = subscription.state == SubsState.EXPECTING_PAY and subscription.wait_until
+        if scheduled.exists():
+            scheduled.delete()
+        elif not expecting:
+            return  # nothing changed
+        if expecting:
+            cls.objects.create(event_id=subscription.event_id, subscription=subscription,
+                               kind=DeadlineKind.PAYMENT, due_at=subscription.wait_until)
+        cls._update_next_deadline(subscription.event_id)
+
+    @classmethod
+    def schedule_payments(cls, event: Event, subscriptions, present):
+        """Replaces all payment deadlines of the event. Waits that are already over are not kept."""
+        cls.objects.filter(event=event, subscription__isnull=False).delete()
+        cls.objects.bulk_create(
+            cls(event=event, subscription=s, kind=DeadlineKind.PAYMENT, due_at=s.wait_until) for s in subscriptions
+            if s.state == SubsState.EXPECTING_PAY and s.wait_until and s.wait_until > present)
+        event.next_deadline = cls._update_next_deadline(event.id)
+
+    @classmethod
+    def _update_next_deadline(cls, event_id):
+        next_deadline = cls.objects.filter(event_id=event_id).values_list('due_at', flat=True).first()
+        Event.objects.filter(id=event_id).update(next_deadline=next_deadline)
+        return next_deadline
+
+    @classmethod
+    def next_due(cls):
+        return cls.objects.filter(event__starts_at__gt=now()).values_list('due_at', flat=True).first()
+
+
+class OrphanedFile(models.Model):
+    """
+    A stored file that no transaction pointed at when last checked. It's only deleted once it has stayed that way
+    for a while; see storage.delete_unused.
+    """
+    digest = models.CharField(max_length=64, primary_key=True)
+    since = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.digest
+
+
+class WorkerHeartbeat(models.Model):
+    """Written by each esupa_worker on every loop, so staff and monitoring can tell whether it's alive."""
+    name = models.CharField(max_length=100, primary_key=True)
+    host = models.CharField(max_length=255)
+    pid = models.IntegerField()
+    started_at = models.DateTimeField()
+    beat_at = models.DateTimeField()
+    next_due = models.DateTimeField(null=True, blank=True)
+    stopped = models.BooleanField(default=False)
+
+    def __str__(self):
+        return self.name
+
+    def is_alive(self, tolerance: timedelta) -> bool:
+        return not self.stopped and self.beat_at + tolerance > now()
+
+
+class Lease(models.Model):
+    """A named lock with an expiry, held by one owner at a time across every process. See the locks module."""
+    name = models.CharField(max_length=50, primary_key=True)
+    owner = models.CharField(max_length=100, blank=True)
+    acquired_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    released_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def held(self) -> bool:
+        return bool(self.owner) and self.expires_at is not None and self.expires_at > now()
+
+    def as_dict(self) -> dict:
+        return {'name': self.name, 'running': self.held, 'owner': self.owner or None,
+                'startedAt': self.acquired_at, 'expiresAt': self.expires_at, 'finishedAt': self.released_at}
+
+
+class OutboxMessage(models.Model):
+    """
+    Mail waiting to be delivered. It's written in the same transaction as the change it tells about, so it goes
+    out if and only if that change is committed. See mailer.deliver_outbox.
+    """
+    recipients = models.TextField()  # one per line
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_body = models.TextField(blank=True)  # sent as an alternative to the text, when present
+    dedup_key = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=now)
+    attempts = models.SmallIntegerField(default=0)
+    claimed_by = models.CharField(max_length=32, blank=True, db_index=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    dead = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        index_together = (('sent_at', 'dead', 'next_attempt_at'),)
+
+    def __str__(self):
+        return self.subject
+
+    @classmethod
+    def enqueue(cls, recipients, subject, body, dedup_key=None, html_body=''):
+        """Adds a message, unless one with the same dedup_key was ever added. Returns it, or None if skipped."""
+        if not recipients:
+            return None
+        message = cls(recipients='\n'.join(recipients), subject=subject[:255], body=body, html_body=html_body,
+                      dedup_key=dedup_key)
+        if dedup_key is None:
+            message.save()
+            return message
+        try:
+            with transaction.atomic():  # a savepoint, so a duplicate doesn't spoil the caller's transaction
+                message.save()
+        except IntegrityError:
+            log.info('Skipped duplicate mail %s', dedup_key)
+            return None
+        return message
+
+    @classmethod
+    def pending(cls):
+        return cls.objects.filter(sent_at__isnull=True, dead=False)
+
+    @classmethod
+    def next_due(cls):
+        message = cls.pending().order_by('next_attempt_at').only('next_attempt_at').first()
+        return message and message.next_attempt_at
+
+
+class StaffDigestItem(models.Model):
+    """A staff notification waiting for the next digest of its event. See notify.flush_staff_digests."""
+    event = models.ForeignKey(Event)
+    kind = models.CharField(max_length=20)
+    text = models.TextField()
+    link = models.CharField(max_length=255, blank=True)  # absolute, since digests are sent without a request
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def __str__(self):
+        return self.text
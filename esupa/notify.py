@@ -11,33 +11,118 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 #
+"""
+E-mail notifications. Staff notifications about single subscriptions are gathered into one digest per event,
+sent once the oldest has waited ESUPA_STAFF_DIGEST_SECONDS (600), or right away when ESUPA_STAFF_DIGEST_MAX (50)
+are waiting. Set the former to 0 to have them sent one by one instead.
+"""
+from collections import OrderedDict
+from datetime import timedelta
 from logging import getLogger
-from random import randint
-from threading import Thread
+from urllib.parse import urljoin
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.mail import EmailMessage
 from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.db.models import Count, Min
+from django.db.models.signals import post_delete, post_save
+from django.template.loader import get_template
 from django.utils.timesince import timeuntil
+from django.utils.timezone import now
 from django.utils.translation import ugettext
 
-from .models import Event, Subscription, SubsState
+from .caching import bump_version, get_cache, versioned_key
+from .models import Event, OutboxMessage, StaffDigestItem, Subscription, SubsState
 
 log = getLogger(__name__)
 
+DIGEST_SECTIONS = OrderedDict((
+    ('upload', 'Receipts uploaded'),
+    ('state', 'State changes'),
+))
 
-def _mail(recipients, subject, body):
-    it = 'mail#%d' % randint(0, 0x10000)
+STAFF_FIELDS = {'is_staff', 'email'}
 
-    def mail():
-        try:
-            log.info("Trying to send %s to %s about %s", it, ','.join(recipients), subject)
-            EmailMessage(subject, '\n'.join(body), to=recipients).send(fail_silently=True)
-            log.info("Sent %s alright", it)
-        except ConnectionRefusedError:
-            log.error("Connection failed for %s to %s", it, ','.join(recipients), exc_info=True)
 
-    Thread(target=mail, name=it).start()  # this will come back to bite our butt, rest assured.
+def staff_emails() -> list:
+    """Addresses of every staff user, from the shared cache. See _staff_changed."""
+    cache = get_cache()
+    key = versioned_key('staff')
+    staff = cache.get(key)
+    if staff is None:
+        staff = list(User.objects.filter(is_staff=True).exclude(email='').values_list('id', 'email'))
+        cache.set(key, staff, 86400)
+    return [email for (uid, email) in staff]
+
+
+def _staff_changed(sender, instance: User, update_fields=None, **kwargs):
+    """Drops the cached staff list if this user came in, left, or changed address. Logins don't count."""
+    if update_fields is not None and not STAFF_FIELDS.intersection(update_fields):
+        return
+    staff = get_cache().get(versioned_key('staff'))
+    if staff is None:
+        return
+    deleted = kwargs.get('signal') is post_delete
+    expected = instance.email if instance.is_staff and instance.email and not deleted else None
+    if dict(staff).get(instance.pk) != expected:
+        bump_version('staff')
+
+
+def connect():
+    """Called once at startup by EsupaConfig.ready()."""
+    post_save.connect(_staff_changed, sender=User, dispatch_uid='esupa.notify.staff.save')
+    post_delete.connect(_staff_changed, sender=User, dispatch_uid='esupa.notify.staff.delete')
+
+
+def _digest_window() -> timedelta:
+    return timedelta(seconds=getattr(settings, 'ESUPA_STAFF_DIGEST_SECONDS', 600))
+
+
+def flush_staff_digests(everything=False) -> int:
+    """Sends the digests that are due, or every one waiting if asked to. Returns how many were sent."""
+    oldest_allowed = now() - _digest_window()
+    limit = getattr(settings, 'ESUPA_STAFF_DIGEST_MAX', 50)
+    sent = 0
+    for row in StaffDigestItem.objects.order_by().values('event_id').annotate(first=Min('created_at'),
+                                                                              count=Count('id')):
+        if everything or row['first'] <= oldest_allowed or row['count'] >= limit:
+            sent += _flush_digest(row['event_id'])
+    return sent
+
+
+def next_digest_due():
+    first = StaffDigestItem.objects.aggregate(first=Min('created_at'))['first']
+    return first and first + _digest_window()
+
+
+def _flush_digest(event_id) -> int:
+    from .views import SubscriptionList
+    with transaction.atomic():
+        items = list(StaffDigestItem.objects.select_for_update().filter(event_id=event_id).select_related('event'))
+        if not items:
+            return 0  # someone else just sent it
+        event = items[0].event
+        body = ['%d notifications since %s:' % (len(items), items[0].created_at.strftime('%Y-%m-%d %H:%M'))]
+        sections = OrderedDict((kind, []) for kind in DIGEST_SECTIONS)
+        for item in items:
+            sections.setdefault(item.kind, []).append(item)
+        for kind, section in sections.items():
+            if section:
+                body += ['', '== %s (%d) ==' % (DIGEST_SECTIONS.get(kind, kind), len(section))]
+                for item in section:
+                    body += [item.text, '    ' + item.link] if item.link else [item.text]
+        if items[-1].link:
+            body += ['', 'All in %s:' % event.name,
+                     urljoin(items[-1].link, reverse(SubscriptionList.name, args=[event.slug]))]
+        EventNotifier(event).send('Digest: %d notifications' % len(items), *body)
+        StaffDigestItem.objects.filter(id__in=[item.id for item in items]).delete()
+    return 1
+
+
+def _mail(recipients, subject, body, dedup_key=None):
+    """Puts the mail in the outbox, in the current transaction. See mailer.deliver_outbox."""
+    OutboxMessage.enqueue(list(recipients), subject, '\n'.join(body), dedup_key)
 
 
 class EventNotifier:
@@ -48,8 +133,7 @@ class EventNotifier:
 
     def send(self, subject, *body):
         subject = '[%s] %s' % (self.e.name, subject)
-        recipients = User.objects.filter(is_staff=True).values_list('email', flat=True)
-        _mail(recipients, subject, body)
+        _mail(staff_emails(), subject, body)
 
     def sales_closed(self):
         self.send('Sales closed!', 'Sales closed for event #%d (%s)' % (self.e.id, self.e.name))
@@ -67,67 +151,96 @@ class EventNotifier:
         )))
 
 
+class MailTemplate:
+    """
+    The text and HTML versions of a subscriber mail, from ``esupa/mail/<name>.txt`` and ``.html``. Each is
+    compiled once per process, so a batch only pays for rendering. Translations are picked at render time, from
+    the active language.
+    """
+    _compiled = {}
+
+    def __init__(self, name):
+        self.text = get_template('esupa/mail/%s.txt' % name)
+        self.html = get_template('esupa/mail/%s.html' % name)
+
+    @classmethod
+    def get(cls, name):
+        template = cls._compiled.get(name)
+        if template is None:
+            template = cls._compiled[name] = cls(name)
+        return template
+
+    def render(self, context: dict) -> tuple:
+        return self.text.render(context), self.html.render(context)
+
+
+def send_batch(name, subject, subscriptions, dedup_kind=None, **context):
+    """Puts one mail per subscription in the outbox, all rendered from the same templates and subject."""
+    template = MailTemplate.get(name)
+    subject = str(subject)
+    for subscription in subscriptions:
+        event = subscription.event
+        text, html = template.render(dict(context, sub=subscription, event=event, rule='=' * len(event.name)))
+        dedup_key = dedup_kind and _dedup_key(dedup_kind, subscription)
+        OutboxMessage.enqueue([subscription.email], '%s - %s' % (subject, event.name), text, dedup_key, html)
+
+
+def _dedup_key(kind, subscription: Subscription):
+    # created_at is stamped whenever the state changes, so this is once per kind and state change.
+    return '%s:%d:%d' % (kind, subscription.id, subscription.created_at.timestamp())
+
+
 class Notifier:
     """ Sends e-mails to subscribers. """
 
     def __init__(self, subscription: Subscription):
         self.s = subscription
 
-    def _send(self, subject, *body):
-        event = self.s.event
-        subject = '%s - %s' % (subject, event.name)
-        body = (self.s.badge + ',', '') + body + ('', '=' * len(event.name), event.name)
-        _mail([self.s.email], subject, body)
-
     def can_pay(self):
         """This can happen in two cases, (1) esupa staff data verify accepted, or (2) the queue moved."""
-        self._send(ugettext("Payment Available"),
-                   ugettext("Your subscription may be paid now. After payment is confirmed, the spot is yours."))
+        send_batch('can_pay', ugettext("Payment Available"), [self.s], 'can-pay')
 
     def expired(self):
         """This means we've waited too long and the subscription can no longer be paid."""
-        hours = self.s.event.payment_wait_hours
-        self._send(ugettext("Payment Expired"),
-                   ugettext("Your %d hour deadline was missed and you've been moved off the payment queue.") % hours)
+        send_batch('expired', ugettext("Payment Expired"), [self.s], 'expired')
 
     def data_denied(self):
         """Esupa staff data verify failed."""
-        self._send(ugettext("Subscription Denied"),
-                   ugettext("Your data has been verified and your subscription has been denied."))
+        send_batch('data_denied', ugettext("Subscription Denied"), [self.s])
 
     def confirmed(self):
         """Pay has been accepted."""
-        self._send(ugettext("Subscription Confirmed"),
-                   ugettext("Welcome! Your subscription is confirmed. :)"))
+        send_batch('confirmed', ugettext("Subscription Confirmed"), [self.s])
 
     def pay_denied(self):
         """Pay has been denied by the processor."""
-        self._send(ugettext("Payment Cancelled"),
-                   ugettext("The payment processor has cancelled your payment."))
+        send_batch('pay_denied', ugettext("Payment Cancelled"), [self.s])
 
     def saved(self, old_state, build_absolute_uri):
         from .views import view
-        self._send(
-            ugettext("Subscription Saved"),
-            ugettext("Your changes were saved."),
-            "",
-            ugettext("Your subscription is now: %s") % self.s.str_state,
-            "",
-            ugettext("Should you need to make any further updates, go to:"),
-            build_absolute_uri(reverse(view.name, args=[self.s.event.slug])))
+        send_batch('saved', ugettext("Subscription Saved"), [self.s],
+                   url=build_absolute_uri(reverse(view.name, args=[self.s.event.slug])))
         if old_state != self.s.state:
             new_state = self.s.state
             notification = "Changed from %d (%s) to %d (%s)" % (
                 old_state, SubsState(old_state), new_state, SubsState(new_state))
             self.notify_staff(notification, build_absolute_uri)
 
-    def notify_staff(self, notification: str, build_absolute_uri):
+    def notify_staff(self, notification: str, build_absolute_uri, kind='state'):
         from .views import TransactionList, SubscriptionList
+        link = build_absolute_uri(reverse(TransactionList.name, args=[self.s.id]))
+        text = "Subscription #%d %s %s: %s" % (self.s.id, self.s.email, self.s.badge, notification)
+        if _digest_window():
+            StaffDigestItem.objects.create(event_id=self.s.event_id, kind=kind, text=text, link=link)
+            if StaffDigestItem.objects.filter(event_id=self.s.event_id).count() >= \
+                    getattr(settings, 'ESUPA_STAFF_DIGEST_MAX', 50):
+                _flush_digest(self.s.event_id)
+            return
         EventNotifier(self.s.event).send(
             "Check: %s" % self.s.badge,
             "Subscription #%d %s %s:" % (self.s.id, self.s.email, self.s.badge),
             notification,
-            build_absolute_uri(reverse(TransactionList.name, args=[self.s.id])),
+            link,
             "",
             "All in %s:" % self.s.event.name,
             build_absolute_uri(reverse(SubscriptionList.name, args=[self.s.event.slug])))
@@ -137,20 +250,22 @@ class BatchNotifier:
     def __init__(self):
         self._expired = []
         self._can_pay = []
-        self._event_toggled = None
-        self.expired = self._expired.append
-        self.can_pay = self._can_pay.append
+        self._events_toggled = []
+
+    def expired(self, subscription: Subscription):
+        self._expired.append(subscription)
+
+    def can_pay(self, subscription: Subscription):
+        self._can_pay.append(subscription)
 
     def toggled(self, event: Event):
-        self._event_toggled = event
+        self._events_toggled.append(event)
 
     def send_notifications(self):
-        for subscription in self._expired:
-            Notifier(subscription).expired()
-        for subscription in self._can_pay:
-            Notifier(subscription).can_pay()
-        if self._event_toggled:
-            EventNotifier(self._event_toggled).toggled()
+        send_batch('expired', ugettext("Payment Expired"), self._expired, 'expired')
+        send_batch('can_pay', ugettext("Payment Available"), self._can_pay, 'can-pay')
+        for event in self._events_toggled:
+            EventNotifier(event).toggled()
 
     def __repr__(self):
         if self._expired or self._can_pay:
@@ -11,28 +11,47 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 #
-from importlib import import_module
+"""
+Payment methods are configured in ESUPA_PAYMENT_METHODS, a mapping of each method code to the dotted path of its
+PaymentMethod class. Nothing is imported until a method is first asked for, and gateway SDKs not even then: each
+method imports its own when it actually talks to the gateway. Methods that fail to load are remembered as such,
+and not retried until the process restarts. Set ESUPA_PAYMENT_WARMUP to load them all at startup instead.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from importlib.util import find_spec
 from logging import getLogger
-from os.path import dirname
-from pkgutil import walk_packages
+from threading import Lock
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.db.models import QuerySet
 from django.http import HttpResponse, HttpRequest
+from django.utils.module_loading import import_string
 
+from ..locks import lock_event
 from ..models import Transaction, Subscription
 
 log = getLogger(__name__)
 
-payment_methods = {}
-payment_names = {}
+_package = __name__.rpartition('.')[0]
+DEFAULT_METHODS = OrderedDict((
+    (1, _package + '.deposit.PaymentMethod'),
+    (2, _package + '.pagseguro.PaymentMethod'),
+    (3, _package + '.paypal.PaymentMethod'),
+))
+
+payment_methods = {}  # code -> PaymentMethod class, for those that loaded
+payment_failures = {}  # code -> why it didn't
+payment_names = OrderedDict()  # code -> title, for those that loaded
+_load_lock = Lock()
 
 
 class PaymentBase:
     CODE = 0
     TITLE = ''
     CONFIGURATION_KEYS = ()
+    REQUIRED_MODULES = ()  # imported by the method when needed; only looked up at load time
 
     @classmethod
     def static_init(cls):
@@ -40,6 +59,9 @@ class PaymentBase:
         missing = tuple(filter(is_missing, cls.CONFIGURATION_KEYS))
         if missing:
             raise NoConfiguration(missing)
+        for module in cls.REQUIRED_MODULES:
+            if find_spec(module) is None:
+                raise ImportError('No module named %r' % module, name=module)
 
     _subscription = None
     _transaction = None
@@ -97,6 +119,27 @@ class PaymentBase:
                 raise ValueError('Invalid change of subscription with saved transaction. tid=%d, sid=%d' %
                                  (self._transaction.id, self._subscription.id))
 
+    @contextmanager
+    def callback_changes(self, note: str):
+        """
+        Applies what the processor reported, in the block, and saves it in one database transaction together with
+        the notifications it sends, so mail only goes out for changes that were committed. The event's queue lock is
+        taken first, as the block may free a seat. Should the block fail, the note is still added to the transaction,
+        so there's a record of what was reported.
+        """
+        try:
+            with lock_event(self.subscription.event_id):
+                self.transaction.notes += note
+                yield
+                self.transaction.save()
+                self.subscription.save()
+        except Exception:
+            if self.transaction.id:
+                recorded = Transaction.objects.get(id=self.transaction.id)
+                recorded.notes += note
+                recorded.save(update_fields=['notes'])
+            raise
+
     def start_payment(self, request, amount) -> HttpResponse:
         raise NotImplementedError
 
@@ -116,40 +159,54 @@ class PaymentBase:
 
 
 def get_payment(code: int) -> type:
-    load_submodules()
+    if code not in payment_methods:
+        _load(code)
     return payment_methods[code]
 
 
 def get_payment_names() -> dict:
-    load_submodules()
+    """Titles of the methods that loaded, by code. Only the first call loads anything."""
+    if len(payment_methods) + len(payment_failures) < len(configured_methods()):
+        load_payment_methods()
     return payment_names
 
 
-def load_submodules():
-    if payment_methods:
-        return
-    path = dirname(__file__)
-    log.debug('Will traverse %s', path)
-    for loader, modname, ispkg in walk_packages([path]):
-        log.debug('Found sub%s %s' % ('package' if ispkg else 'module', modname))
+def configured_methods() -> dict:
+    return getattr(settings, 'ESUPA_PAYMENT_METHODS', DEFAULT_METHODS)
+
+
+def load_payment_methods():
+    """Loads every configured method that wasn't tried yet. Called at startup when ESUPA_PAYMENT_WARMUP is set."""
+    for code in configured_methods():
+        _load(code)
+
+
+def _load(code: int):
+    global payment_names
+    path = configured_methods().get(code)
+    if path is None:
+        return  # not one of ours; get_payment raises KeyError
+    with _load_lock:
+        if code in payment_methods or code in payment_failures:
+            return
         try:
-            module = import_module(__name__[:-4] + modname)
-            log.debug('Imported payment module: %s', modname)
-            if hasattr(module, 'PaymentMethod'):
-                subclass = module.PaymentMethod
-                subclass.static_init()
-                payment_methods[subclass.CODE] = subclass
-                payment_names[subclass.CODE] = subclass.TITLE
-                log.info('Payment module %s loaded: code=%d, title=%s', modname, subclass.CODE, subclass.TITLE)
-            else:
-                log.debug('No class PaymentMethod in module: %s', modname)
+            subclass = import_string(path)
+            if subclass.CODE != code:
+                raise ValueError('%s has code %d' % (path, subclass.CODE))
+            subclass.static_init()
         except NoConfiguration as e:
-            log.info('Payment module %s disabled due to missing configuration: %s', modname, ', '.join(e.keys))
-        except ImportError as e:
-            log.warn('Failed to import payment module %s: %s', modname, e.msg)
-        except SyntaxError as e:
-            log.warn('Failed to import payment module %s', modname)
+            log.info('Payment method %s disabled due to missing configuration: %s', path, ', '.join(e.keys))
+            payment_failures[code] = e
+        except (ImportError, SyntaxError, ValueError) as e:
+            log.warning('Failed to load payment method %s: %s', path, e)
             log.debug(e, exc_info=True)
+            payment_failures[code] = e
+        else:
+            payment_methods[code] = subclass
+            # Kept in configuration order for the pay buttons, and replaced whole so readers never see it half built.
+            payment_names = OrderedDict((c, payment_methods[c].TITLE) for c in configured_methods()
+                                        if c in payment_methods)
+            log.info('Payment method %s loaded: code=%d, title=%s', path, code, subclass.TITLE)
 
 
 class NoConfiguration(Exception):
@@ -17,13 +17,15 @@ from logging import getLogger
 from django import forms
 from django.core.exceptions import PermissionDenied, SuspiciousOperation
 from django.http import HttpRequest, HttpResponse
+from django.db.transaction import atomic
 from django.shortcuts import render
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy, ugettext
 
-from esupa.esupa.notify import Notifier
 from .base import PaymentBase
 from ..models import Transaction, SubsState
+from ..notify import Notifier
+from ..storage import uploaded_files, validate_receipt_size
 from ..utils import prg_redirect
 
 log = getLogger(__name__)
@@ -38,11 +40,14 @@ class PaymentMethod(PaymentBase):
         # If the transaction above is set to None, the call below will automatically create a new one.
         self.transaction.amount = amount
         self.transaction.save()
+        return self._render_form(request, DepositForm(self.transaction))
+
+    def _render_form(self, request: HttpRequest, form) -> HttpResponse:
         context = {
             'event': self.subscription.event,
             'sub': self.subscription,
             'trans': self.transaction,
-            'form': DepositForm(self.transaction),
+            'form': form,
         }
         return render(request, 'esupa/deposit.html', context)
 
@@ -51,24 +56,28 @@ class PaymentMethod(PaymentBase):
         if not request.user or 'tid' not in request.POST:
             raise PermissionDenied
         transaction = Transaction.objects.get(id=int(request.POST['tid']))
+        files = uploaded_files(request)
         if transaction.subscription.user != request.user:
             raise SuspiciousOperation
-        elif 'upload' in request.FILES:
+        elif 'upload' in files:
             if transaction.subscription.state == SubsState.QUEUED_FOR_PAY:
                 raise PermissionDenied
             payment = PaymentMethod(transaction)
-            payment.put_file(request.FILES['upload'], request.POST['amount'])
-            Notifier(transaction.subscription).notify_staff(
-                "Uploaded a new deposit file.",
-                request.build_absolute_uri)
+            form = DepositForm(transaction, request.POST, files)
+            if not form.is_valid():
+                return payment._render_form(request, form)
+            with atomic():
+                payment.put_file(form.cleaned_data['upload'], form.cleaned_data['amount'])
+                Notifier(transaction.subscription).notify_staff(
+                    "Uploaded a new deposit file.",
+                    request.build_absolute_uri, kind='upload')
             return prg_redirect(payment.my_view_url(request))
         else:
             return PaymentMethod(transaction).start_payment(request, transaction.amount)
 
     def put_file(self, upload, amount):
         transaction = self.transaction
-        transaction.mimetype = upload.content_type or 'application/octet-stream'
-        transaction.document = upload.read()
+        transaction.attach_document(upload.chunks(), upload.content_type or 'application/octet-stream')
         transaction.filled_at = now()
         transaction.amount = Decimal(amount)
         transaction.save()
@@ -78,7 +87,7 @@ class PaymentMethod(PaymentBase):
 
 class DepositForm(forms.Form):
     amount = forms.DecimalField(label=ugettext_lazy('Amount Transferred'), max_digits=7, decimal_places=2)
-    upload = forms.FileField(label=ugettext_lazy('Receipt'))
+    upload = forms.FileField(label=ugettext_lazy('Receipt'), validators=[validate_receipt_size])
 
     def __init__(self, transaction: Transaction, *args, **kwargs):
         forms.Form.__init__(self, *args, **kwargs)
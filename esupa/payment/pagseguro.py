@@ -14,8 +14,6 @@
 from logging import getLogger
 
 from django.http import HttpRequest
-from pagseguro.api import PagSeguroApi, PagSeguroItem  # sudo -H pip3 install django-pagseguro2
-from pagseguro.settings import TRANSACTION_STATUS
 
 from .base import PaymentBase
 from ..models import SubsState, Transaction
@@ -30,8 +28,10 @@ class PaymentMethod(PaymentBase):
     CODE = 2
     TITLE = 'PagSeguro'
     CONFIGURATION_KEYS = ('PAGSEGURO_EMAIL', 'PAGSEGURO_TOKEN')
+    REQUIRED_MODULES = ('pagseguro',)
 
     def start_payment(self, request, amount):
+        from pagseguro.api import PagSeguroApi, PagSeguroItem  # sudo -H pip3 install django-pagseguro2
         event = self.subscription.event
         api = PagSeguroApi()
         self.transaction.amount = amount
@@ -49,6 +49,7 @@ class PaymentMethod(PaymentBase):
 
     @classmethod
     def class_view(cls, request: HttpRequest):
+        from pagseguro.api import PagSeguroApi
         notification_code = request.POST.get('notificationCode', None)
         notification_type = request.POST.get('notificationType', None)
         if notification_code and notification_type == 'transaction':
@@ -59,17 +60,13 @@ class PaymentMethod(PaymentBase):
             payment.callback_view(data)
 
     def callback_view(self, data: dict):
-        try:
-            self.transaction.remote_identifier = data['code']
-            self.transaction.notes += '\n[%s] %s %s' % (data['lastEventDate'], data['code'], data['status'])
+        from pagseguro.settings import TRANSACTION_STATUS
+        self.transaction.remote_identifier = data['code']
+        with self.callback_changes('\n[%s] %s %s' % (data['lastEventDate'], data['code'], data['status'])):
             queue = QueueAgent(self.subscription)
             notify = Notifier(self.subscription)
             status = TRANSACTION_STATUS[data['status']]
             self.status_callback[status](self, status=status, queue=queue, notify=notify)
-        finally:
-            # No rollbacks please!
-            self.transaction.save()
-            self.subscription.save()
 
     status_callback = FunctionDictionary()
 
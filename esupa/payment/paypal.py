@@ -16,7 +16,6 @@ from logging import getLogger
 from django.conf import settings
 from django.core.exceptions import SuspiciousOperation
 from django.http import HttpRequest
-from paypalrestsdk import configure, Payment  # sudo -H pip3 install paypalrestsdk
 
 from .base import PaymentBase
 from ..notify import Notifier
@@ -25,6 +24,18 @@ from ..utils import FunctionDictionary, prg_redirect
 
 log = getLogger(__name__)
 
+_sdk = None
+
+
+def _paypal():
+    """The configured SDK, imported on first use."""
+    global _sdk
+    if _sdk is None:
+        import paypalrestsdk  # sudo -H pip3 install paypalrestsdk
+        paypalrestsdk.configure(settings.PAYPAL)
+        _sdk = paypalrestsdk
+    return _sdk
+
 
 def _find_href(links, rel):
     for link in links:
@@ -37,16 +48,12 @@ class PaymentMethod(PaymentBase):
     CODE = 3
     TITLE = 'PayPal'
     CONFIGURATION_KEYS = ('PAYPAL',)
-
-    @classmethod
-    def static_init(cls):
-        super().static_init()
-        configure(settings.PAYPAL)
+    REQUIRED_MODULES = ('paypalrestsdk',)
 
     def start_payment(self, request, amount):
         event = self.subscription.event
         self.transaction.amount = amount
-        payment = Payment({
+        payment = _paypal().Payment({
             'transactions': [{'amount': {'total': amount.to_eng_string(),
                                          'currency': 'BRL'},
                               'description': event.name}],
@@ -69,7 +76,7 @@ class PaymentMethod(PaymentBase):
         if not payment_id:
             raise SuspiciousOperation
         payment = PaymentMethod(payment_id)
-        paypal = Payment.find(payment_id)
+        paypal = _paypal().Payment.find(payment_id)
         if not paypal.execute({'payer_id': payer_id}):
             raise ValueError('PayPal did not complete pmt %s' % payment_id)
         payment.callback_view(paypal)
@@ -78,16 +85,11 @@ class PaymentMethod(PaymentBase):
         return prg_redirect(payment.my_view_url(request))
 
     def callback_view(self, data: dict):
-        try:
-            self.transaction.notes += '\n[%s] %s %s' % (data['update_time'], data['id'], data['state'])
+        with self.callback_changes('\n[%s] %s %s' % (data['update_time'], data['id'], data['state'])):
             queue = QueueAgent(self.subscription)
             notify = Notifier(self.subscription)
             state = data['state']
             self.state_callback.get(state)(self, state=state, queue=queue, notify=notify)
-        finally:
-            # No rollbacks please!
-            self.transaction.save()
-            self.subscription.save()
 
     @FunctionDictionary
     def state_callback(self, state: str, **_):
@@ -12,41 +12,32 @@
 # See the License for the specific language governing permissions and limitations under the License.
 #
 """
-Very simple implementation designed for single server, single process, few users.
+Very simple implementation designed for few servers and few users. Operations on one event's queue are
+serialized by the lock backend chosen in the locks module, which can span processes and hosts.
 
 May scalability ever become an issue, replace this with something like Celery and
 RabbitMQ. Let's not reinvent the wheel too much, shall we?
 """
-from json import dumps, loads
+from datetime import timedelta
 from logging import getLogger
-from threading import Lock
+from multiprocessing import get_context
+from time import perf_counter
 
-from django.core.exceptions import ObjectDoesNotExist
-from django.db import transaction
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, transaction
+from django.db.models import Q
 from django.utils.timezone import now
 
-from .models import Event, QueueContainer, Subscription, SubsState
+from . import catalog
+from .locks import lock_event, lease, LeaseHeld, wait_for_lease
+from .models import Deadline, Event, Lease, QueueEntry, SubsState
 from .notify import BatchNotifier
+from .utils import bulk_update
 
 log = getLogger(__name__)
 
 
-class LockDict(dict):
-    def __init__(self, lock=Lock, **kwargs):
-        self.lock = lock
-        self.outer = lock()
-        super().__init__(**kwargs)
-
-    def __getitem__(self, key):
-        with self.outer:
-            if key not in self:
-                self[key] = self.lock()
-            return super().__getitem__(key)
-
-
-_lock = LockDict()
-
-
 class QueueAgent:
     """
     This agent will atomically act upon the event queue on behalf of one subscription.
@@ -72,78 +63,101 @@ class QueueAgent:
         return self.pos
 
     def remove(self):
-        """Removes from queue if not there."""
+        """
+        Removes from queue if there, and promotes whoever is next in line if a seat was freed. Should that sweep
+        fail, the removal still stands and the event is left marked for the next cron run.
+        """
         self.pos = None
-        return self._atomic_db_write(_remove)
+        if self._atomic_db_write(_remove):
+            Event.mark_for_sweep(self.eid)
+            try:
+                with transaction.atomic():  # a savepoint, so a failed sweep doesn't spoil the caller's transaction
+                    sweep(self.eid)
+            except Exception:
+                log.exception('Could not sweep event #%d after a seat was freed; leaving it to cron.', self.eid)
 
     def _atomic_db_read(self, operation):
-        with _lock[self.eid]:
-            qc, created = QueueContainer.objects.get_or_create(event_id=self.eid)
-            queue = [] if created else loads(qc.data)
-            return operation(queue, self.s.id)
+        with lock_event(self.eid):
+            return operation(self.eid, self.s.id)
 
     def _atomic_db_write(self, operation):
-        with _lock[self.eid]:
-            qc, created = QueueContainer.objects.get_or_create(event_id=self.eid)
-            queue = [] if created else loads(qc.data)
-            result = operation(queue, self.s.id)
-            qc.data = dumps(queue)
-            qc.save()  # assuming autocommit is on
-            return result
+        with lock_event(self.eid):
+            return operation(self.eid, self.s.id)
 
 
-def _ghost_add(queue, sid):
-    try:
-        return queue.index(sid)
-    except ValueError:
-        return len(queue)
+def _position(eid, key) -> int:
+    return QueueEntry.objects.filter(event_id=eid, id__lt=key).count()
 
 
-def _add(queue, sid):
-    try:
-        return queue.index(sid)
-    except ValueError:
-        queue.append(sid)
-        return len(queue) - 1
+def _ghost_add(eid, sid):
+    key = QueueEntry.objects.filter(subscription_id=sid).values_list('id', flat=True).first()
+    return QueueEntry.objects.filter(event_id=eid).count() if key is None else _position(eid, key)
 
 
-def _remove(queue, sid):
-    try:
-        queue.remove(sid)
-    except ValueError:
-        pass
+def _add(eid, sid):
+    entry, created = QueueEntry.objects.get_or_create(subscription_id=sid, defaults={'event_id': eid})
+    return _position(eid, entry.id)
+
+
+def _remove(eid, sid) -> bool:
+    entries = QueueEntry.objects.filter(subscription_id=sid)
+    if entries.exists():
+        entries.delete()
+        return True
+    else:
+        return False
+
+
+def _queue_of(event) -> list:
+    return list(QueueEntry.objects.filter(event=event).values_list('subscription_id', flat=True))
+
+
+def _save_queue(event, old_queue, queue):
+    """Persists the changes made to the in-memory queue; new entries go to the end, in order."""
+    dropped = set(old_queue).difference(queue)
+    if dropped:
+        QueueEntry.objects.filter(event=event, subscription_id__in=dropped).delete()
+    kept = set(old_queue)
+    QueueEntry.objects.bulk_create(QueueEntry(event=event, subscription_id=sid) for sid in queue if sid not in kept)
 
 
 def _update_all_subscriptions(event, notify):
-    """Oh boy, this will take a while. But it has to be done sometimes."""
-    if event.check_toggles():
+    """
+    Walks the whole queue of the event and fixes every subscription in it.
+
+    Everything is loaded upfront and changes are written in bulk, so the number of queries doesn't depend on the
+    number of subscriptions. Bulk writes skip Subscription.save(), so counters and occupancy are taken care of
+    once at the end.
+    """
+    present = now()
+    if event.check_toggles(present):
         event.save()
         notify.toggled(event)
-    try:
-        qc = QueueContainer.objects.get(event=event)
-    except QueueContainer.DoesNotExist:
-        return
-    queue = loads(qc.data)
+    subscriptions = {}
+    # Locked, so the states read here are still the ones in the database when the counters are shifted below.
+    for subscription in event.subscription_set.select_for_update().order_by('id'):
+        subscription.event = event  # spares one query per subscription
+        subscriptions[subscription.id] = subscription
+    old_states = {sid: subscription.state for sid, subscription in subscriptions.items()}
+    old_queue = _queue_of(event)
+    queue = [sid for sid in old_queue if sid in subscriptions]
     log.debug("Queue was: %s", queue)
+    changed = []
     position = 0
     for sid in list(queue):  # iterate over a copy
-        try:
-            subscription = Subscription.objects.get(id=sid)
-        except ObjectDoesNotExist:
-            _remove(queue, sid)
-            continue
+        subscription = subscriptions[sid]
         if subscription.state == SubsState.EXPECTING_PAY and not subscription.waiting:
             subscription.state = SubsState.ACCEPTABLE
             subscription.wait_until = None
             subscription.position = None
-            subscription.save()
+            changed.append(subscription)
             notify.expired(subscription)
-            _remove(queue, sid)
+            queue.remove(sid)
         elif subscription.state == SubsState.QUEUED_FOR_PAY and position < event.capacity:
             subscription.state = SubsState.EXPECTING_PAY
             subscription.waiting = True
-            subscription.position = _add(queue, sid)
-            subscription.save()
+            subscription.position = queue.index(sid)
+            changed.append(subscription)
             notify.can_pay(subscription)
             position += 1
         elif subscription.state == SubsState.PARTIALLY_PAID and not event.partial_payment_open:
@@ -153,30 +167,124 @@ def _update_all_subscriptions(event, notify):
             if subscription.position or subscription.waiting:
                 subscription.waiting = False
                 subscription.position = None
-                subscription.save()
-            _remove(queue, sid)
+                changed.append(subscription)
+            queue.remove(sid)
         else:
             if subscription.position != position:
                 subscription.position = position
-                subscription.save()
+                changed.append(subscription)
             position += 1
-    for subscription in Subscription.objects.filter(event=event).exclude(id__in=queue):
-        if subscription.state >= SubsState.UNPAID_STAFF:
-            subscription.position = _add(queue, subscription.id)
-            subscription.save()
+    queued = set(queue)
+    for sid, subscription in subscriptions.items():
+        if sid in queued:
+            continue
+        elif subscription.state >= SubsState.UNPAID_STAFF:
+            queue.append(sid)
+            subscription.position = len(queue) - 1
+            changed.append(subscription)
         elif subscription.position is not None:
             subscription.position = None
-            subscription.save()
+            changed.append(subscription)
     log.debug("Queue is:  %s", queue)
-    qc.data = dumps(queue)
-    qc.save()
+    for subscription in changed:
+        subscription.created_at = present  # what auto_now would do in save()
+    bulk_update(changed, ('state', 'wait_until', 'position', 'created_at'))
+    if Event.shift_occupancy(event.id, ((old_states[s.id], s.state) for s in changed)):
+        event.refresh_occupancy()
+        event.public_state_changed()
+    _save_queue(event, old_queue, queue)
+    Deadline.schedule_payments(event, subscriptions.values(), present)
+    event.check_occupancy()
 
 
-def cron():
-    for event in Event.objects.filter(starts_at__gt=now()):
-        log.info("Running cron with event: %s", event)
-        notify = BatchNotifier()
-        with _lock[event.id], transaction.atomic():
-            _update_all_subscriptions(event, notify)
-        log.info("About to send notifications: %s", notify)
+def sweep(event_id):
+    """
+    Brings one event up to date right away, e.g. so a freed seat goes to the next in line. Notifications are put in
+    the outbox within the same transaction, so they go out if and only if the changes are committed.
+    """
+    notify = BatchNotifier()
+    with lock_event(event_id):
+        # Locked until this sweep is committed, so whoever marks the event meanwhile does so after it's cleared below.
+        event = Event.objects.select_for_update().get(id=event_id)
+        log.info("Sweeping event: %s", event)
+        _update_all_subscriptions(event, notify)
         notify.send_notifications()
+        Event.objects.filter(id=event_id).update(needs_sweep=False)  # last, as saving the event above marks it too
+
+
+def _timed_sweep(event_id) -> tuple:
+    """Also runs in the pool processes. A failure is logged and timed as None, so the other events still go."""
+    started = perf_counter()
+    try:
+        sweep(event_id)
+    except Exception:
+        log.exception("Could not sweep event #%d", event_id)
+        return event_id, None
+    return event_id, perf_counter() - started
+
+
+def cron(everything=False, workers=1) -> dict:
+    """
+    Sweeps the future events that changed since their last sweep or have a deadline due, or all of them if asked
+    to. Returns how many seconds each event took, leaving out those that failed; they stay marked for the next run.
+
+    Events are independent, so with more than one worker they are shared among a pool of forked processes, each
+    with its own database and cache connections. That requires a database that takes concurrent writers, so not
+    SQLite. Only the esupa_worker command asks for that, as ESUPA_CRON_WORKERS; a web server process may have
+    threads of its own, which a fork would leave behind in an unknown state.
+    """
+    present = now()
+    events = Event.objects.filter(starts_at__gt=present)
+    if not everything:
+        events = events.filter(Q(needs_sweep=True) | Q(next_deadline__lte=present))
+    event_ids = list(events.values_list('id', flat=True))
+    workers = min(workers, len(event_ids))
+    timings = {}
+    if workers > 1:
+        _close_connections()  # or else the children would share the parent's sockets
+        with get_context('fork').Pool(workers, initializer=_forked) as pool:
+            for event_id, elapsed in pool.imap_unordered(_timed_sweep, event_ids):
+                timings[event_id] = elapsed
+    else:
+        for event_id in event_ids:
+            event_id, elapsed = _timed_sweep(event_id)
+            timings[event_id] = elapsed
+    failed = [event_id for event_id, elapsed in timings.items() if elapsed is None]
+    for event_id in failed:
+        del timings[event_id]
+    if timings:
+        log.info("Swept %d events with %d workers, slowest took %.3fs", len(timings), max(workers, 1),
+                 max(timings.values()))
+    if failed:
+        log.error("Could not sweep %d events: %s", len(failed), failed)
+    return timings
+
+
+def _close_connections():
+    connections.close_all()
+    for cache in caches.all():
+        cache.close()
+
+
+def _forked():
+    """Starts a cron pool process without anything it may share with its parent."""
+    _close_connections()
+    catalog.forget()
+
+
+def single_flight_cron(wait=False, everything=False, workers=1) -> dict:
+    """
+    Runs cron() unless it's already running somewhere else. In that case it returns right away with the status of
+    the run in progress, or if ``wait`` is set, it returns once that run is over instead of running it again.
+    """
+    ttl = timedelta(seconds=getattr(settings, 'ESUPA_CRON_LEASE_SECONDS', 600))
+    try:
+        with lease('cron', ttl):
+            timings = cron(everything, workers)
+    except LeaseHeld as e:
+        log.info("Cron already running at %s", e.lease.owner)
+        if not wait:
+            return dict(e.lease.as_dict(), ran=False)
+        return dict(wait_for_lease('cron').as_dict(), ran=False)
+    swept = {str(event_id): round(elapsed, 3) for event_id, elapsed in timings.items()}
+    return dict(Lease.objects.get(name='cron').as_dict(), ran=True, swept=swept)
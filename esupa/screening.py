@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015, Ekevoo.com.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+#
+"""
+Screening of subscriber data against each event's ``data_to_be_checked``: one term per line, matched
+case-insensitively anywhere in the screened fields. Subscriptions with a match are held for staff in
+VERIFYING_DATA.
+
+The terms of each event are compiled into a single regular expression, rebuilt only when they change.
+"""
+from logging import getLogger
+from re import compile, escape
+
+from django.db import transaction
+
+from .models import Event, Subscription, SubsState
+
+log = getLogger(__name__)
+
+FIELDS = ('full_name', 'email', 'document', 'badge')
+EXEMPT_STATES = (SubsState.VERIFYING_DATA, SubsState.DENIED)
+
+_compiled = {}  # event id -> (terms, pattern)
+
+
+def pattern_of(event: Event):
+    """The compiled terms of the event, or None if it has none."""
+    terms = event.data_to_be_checked
+    cached = _compiled.get(event.id)
+    if cached is None or cached[0] != terms:
+        words = {word.lower() for word in terms.splitlines() if word}
+        pattern = compile('|'.join(map(escape, sorted(words, key=len, reverse=True)))) if words else None
+        cached = _compiled[event.id] = (terms, pattern)
+    return cached[1]
+
+
+def _text(values) -> str:
+    # Terms come from splitlines(), so none of them can span this separator.
+    return '\n'.join(value.lower() for value in values)
+
+
+def is_suspect(subscription: Subscription, pattern=None) -> bool:
+    pattern = pattern or pattern_of(subscription.event)
+    return pattern is not None and pattern.search(_text(getattr(subscription, field) for field in FIELDS)) is not None
+
+
+def rescreen(event: Event, batch_size=500) -> int:
+    """
+    Goes through every subscription of the event that isn't already held or denied, and holds those with a match.
+    Reads and writes in batches, skipping rows that changed state meanwhile. Returns how many were held.
+    """
+    pattern = pattern_of(event)
+    if pattern is None:
+        return 0
+    candidates = Subscription.objects.filter(event_id=event.id).exclude(state__in=EXEMPT_STATES).order_by('id')
+    held = last_id = 0
+    while True:
+        batch = list(candidates.filter(id__gt=last_id).values_list('id', 'state', *FIELDS)[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        by_state = {}
+        for row in batch:
+            if pattern.search(_text(row[2:])):
+                by_state.setdefault(row[1], []).append(row[0])
+        for state, ids in by_state.items():
+            with transaction.atomic():
+                count = Subscription.objects.filter(id__in=ids, state=state).update(state=SubsState.VERIFYING_DATA)
+                Event.shift_occupancy(event.id, [(state, SubsState.VERIFYING_DATA)] * count)
+            held += count
+    if held:
+        log.info('Screening held %d subscriptions of %s.', held, event.slug)
+        Event.mark_for_sweep(event.id)
+        event.public_state_changed()
+    return held
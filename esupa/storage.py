@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015, Ekevoo.com.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+#
+"""
+Receipts and other transaction documents, kept out of the database and named after the SHA-256 of their content,
+so the same file uploaded twice is stored once.
+
+ESUPA_RECEIPT_STORAGE may name a Django Storage class to use instead of the default, a FileSystemStorage at
+ESUPA_RECEIPT_ROOT, or ``esupa-receipts`` inside MEDIA_ROOT. Either way, don't serve it publicly.
+Uploads larger than ESUPA_RECEIPT_MAX_BYTES (10 MiB by default) are refused, without being read any further than
+that where the view installs ReceiptUploadHandler.
+
+Files nobody points at any more are deleted by the worker, once they've stayed that way for
+ESUPA_RECEIPT_GRACE_SECONDS (an hour by default). Meanwhile an upload of the same content claims them back.
+"""
+from datetime import timedelta
+from hashlib import sha256
+from io import BytesIO
+from logging import getLogger
+from os.path import join
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.db import transaction
+from django.db.models import Q
+from django.template.defaultfilters import filesizeformat
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
+from django.utils.translation import ugettext
+
+log = getLogger(__name__)
+
+_storage = None
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        if hasattr(settings, 'ESUPA_RECEIPT_STORAGE'):
+            _storage = import_string(settings.ESUPA_RECEIPT_STORAGE)()
+        else:
+            root = getattr(settings, 'ESUPA_RECEIPT_ROOT', None) or join(settings.MEDIA_ROOT, 'esupa-receipts')
+            _storage = FileSystemStorage(location=root, base_url=None)
+    return _storage
+
+
+def name_for(digest: str) -> str:
+    return '%s/%s/%s' % (digest[:2], digest[2:4], digest)
+
+
+def max_bytes() -> int:
+    return getattr(settings, 'ESUPA_RECEIPT_MAX_BYTES', 10 * 1024 * 1024)
+
+
+class ReceiptTooLarge(ValidationError):
+    def __init__(self):
+        super().__init__(ugettext('Files can have up to %s.') % filesizeformat(max_bytes()), code='too_large')
+
+
+def validate_receipt_size(upload):
+    """Form field validator, so the limit is shown as a form error rather than found while storing."""
+    if upload is not None and upload.size > max_bytes():
+        raise ReceiptTooLarge
+
+
+class ReceiptUploadHandler(FileUploadHandler):
+    """
+    Stops keeping an upload as soon as it's past ``max_bytes()``, instead of letting Django buffer all of it first.
+    Django still reads the rest of the request body and throws it away, so the browser gets the form back with the
+    error, but fields that come after the file are lost; forms using this put their file last. Must be installed
+    before anything reads the request body; see ``install``.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > max_bytes():
+            # A stand-in for the form, so the field validator reports it like any other file that's too large.
+            self.request.oversized_uploads[self.field_name] = UploadedFile(
+                BytesIO(), self.file_name, self.content_type, self.received, self.charset)
+            raise StopUpload(connection_reset=False)
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None  # the next handlers keep the file
+
+    @classmethod
+    def install(cls, request):
+        request.oversized_uploads = {}
+        request.upload_handlers.insert(0, cls(request))
+
+
+def uploaded_files(request):
+    """``request.FILES``, plus stand-ins for the uploads ReceiptUploadHandler cut short."""
+    oversized = getattr(request, 'oversized_uploads', None)
+    if not oversized:
+        return request.FILES
+    files = request.FILES.copy()
+    files.update(oversized)
+    return files
+
+
+def store(content: bytes) -> tuple:
+    """Saves the content unless it's already there. Returns its digest and size."""
+    return store_chunks((content,), limit=None)
+
+
+def store_chunks(chunks, limit=-1) -> tuple:
+    """
+    Like ``store``, but takes the content piece by piece, such as ``UploadedFile.chunks()``, spooling to disk as
+    it goes. Raises ReceiptTooLarge as soon as it's past ``limit`` bytes, which is ``max_bytes()`` unless given.
+    """
+    if limit == -1:
+        limit = max_bytes()
+    hasher = sha256()
+    size = 0
+    with SpooledTemporaryFile(max_size=1024 * 1024) as spool:
+        for chunk in chunks:
+            size += len(chunk)
+            if limit is not None and size > limit:
+                raise ReceiptTooLarge
+            hasher.update(chunk)
+            spool.write(chunk)
+        digest = hasher.hexdigest()
+        storage = get_storage()
+        name = name_for(digest)
+        # Claimed back before looking, so purge_orphans either deletes it first or leaves it alone.
+        from .models import OrphanedFile
+        OrphanedFile.objects.filter(digest=digest).delete()
+        if not storage.exists(name):
+            spool.seek(0)
+            storage.save(name, File(spool))
+    return digest, size
+
+
+def open_stored(digest: str):
+    return get_storage().open(name_for(digest), 'rb')
+
+
+def sendfile_location(digest: str, header: str) -> str:
+    """What to tell the front server in the given header so it sends the stored file itself."""
+    name = name_for(digest)
+    if header.lower() == 'x-accel-redirect':
+        return getattr(settings, 'ESUPA_RECEIPT_ACCEL_PREFIX', '/esupa-receipts/') + name
+    return get_storage().path(name)
+
+
+def _is_used(digest: str) -> bool:
+    from .models import Transaction
+    return Transaction.objects.filter(Q(document_hash=digest) | Q(thumbnail_hash=digest)).exists()
+
+
+def delete_unused(digest: str):
+    """
+    Has the stored file deleted later unless some transaction still points at it, as a document or a thumbnail.
+    Not right away: an upload of the same content may have just found it, and not be saved yet.
+    """
+    from .models import OrphanedFile
+    if digest and not _is_used(digest):
+        OrphanedFile.objects.get_or_create(digest=digest, defaults={'since': now()})
+
+
+def purge_orphans(grace=None, batch_size=100) -> int:
+    """Deletes the files that have been unused for longer than the grace period. Returns how many."""
+    from .models import OrphanedFile
+    if grace is None:
+        grace = timedelta(seconds=getattr(settings, 'ESUPA_RECEIPT_GRACE_SECONDS', 3600))
+    cutoff = now() - grace
+    deleted = 0
+    for digest in OrphanedFile.objects.filter(since__lte=cutoff).values_list('digest', flat=True)[:batch_size]:
+        with transaction.atomic():
+            # Locked, so an upload claiming it back waits until this is over, and then stores it again.
+            if not list(OrphanedFile.objects.select_for_update().filter(digest=digest).values_list('digest')):
+                continue  # claimed back meanwhile
+            if not _is_used(digest):
+                get_storage().delete(name_for(digest))
+                deleted += 1
+            OrphanedFile.objects.filter(digest=digest).delete()
+    if deleted:
+        log.info('Deleted %d unused receipt files', deleted)
+    return deleted
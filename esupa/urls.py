@@ -24,6 +24,7 @@ def url(regex, view, kwargs=None, name=None, prefix=''):
 
 urlpatterns = [
     url(r'^pay/(.*)$', views.paying),
+    url(r'^doc/(\d+)/thumb$', views.transaction_thumbnail),
     url(r'^doc/(.+)$', views.transaction_document),
     url(r'^cron/(.+)$', views.cron_view),
     url(r'^check$', views.EventList.as_view()),
@@ -15,6 +15,8 @@
 Pieces of code that do not accomplish any business goal and have no internal dependency.
 """
 from django.core.urlresolvers import reverse
+from django.db import connections
+from django.db.models import Case, Func, Value, When
 from django.http.response import HttpResponseRedirectBase
 
 
@@ -74,3 +76,74 @@ def prg_redirect(destination: str, *args) -> HttpResponseSeeOther:
     if not destination.startswith('http'):
         destination = reverse(destination, args=args)
     return HttpResponseSeeOther(destination)
+
+
+def bulk_update(objects, fields, batch_size=500, using='default') -> int:
+    """
+    Writes the named fields of many model instances with one ``UPDATE ... CASE`` statement per batch.
+
+    Like ``QuerySet.update()``, this skips ``save()`` and signals. Returns how many rows were updated. On
+    PostgreSQL each CASE is cast to its column type, as Django's own ``bulk_update()`` does.
+    """
+    objects = list(objects)
+    if not objects:
+        return 0
+    model = type(objects[0])
+    connection = connections[using]
+    fields = [model._meta.get_field(name) for name in fields]
+    updated = 0
+    for start in range(0, len(objects), batch_size):
+        batch = objects[start:start + batch_size]
+        values = {}
+        for field in fields:
+            whens = [When(pk=obj.pk, then=Value(field.get_db_prep_save(getattr(obj, field.attname), connection)))
+                     for obj in batch]
+            values[field.attname] = case = Case(*whens, output_field=field)
+            if connection.vendor == 'postgresql':
+                # Otherwise a CASE of nothing but NULLs is typed as text, and the UPDATE is refused.
+                values[field.attname] = Func(case, template='CAST(%(expressions)s AS %(db_type)s)',
+                                             db_type=field.db_type(connection), output_field=field)
+        updated += model.objects.using(using).filter(pk__in=[obj.pk for obj in batch]).update(**values)
+    return updated
+
+
+def parse_range(header: str, size: int):
+    """
+    Reads a single byte range from a Range header, as an inclusive ``(first, last)`` pair. Returns None when the
+    header should be ignored (malformed, or asking for several ranges) and raises ValueError when it can't be
+    satisfied.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    first, last = first.strip(), last.strip()
+    if not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        return None
+    first = int(first) if first else None
+    last = int(last) if last else None
+    if first is None:  # suffix: the last N bytes
+        if not last:
+            raise ValueError('Empty suffix range.')
+        return max(0, size - last), size - 1
+    if last is not None and first > last:
+        return None
+    if first >= size:
+        raise ValueError('Range starts beyond the end.')
+    return first, size - 1 if last is None else min(last, size - 1)
+
+
+def iter_file(file, start: int, length: int, chunk_size=65536):
+    """Yields ``length`` bytes of a binary file from ``start``, one chunk at a time, then closes it."""
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
@@ -12,26 +12,37 @@
 # See the License for the specific language governing permissions and limitations under the License.
 #
 from decimal import Decimal, DecimalException
+from hashlib import md5
+from json import dumps
 from logging import getLogger
+from time import time
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied, SuspiciousOperation
-from django.http import HttpResponse, Http404, HttpRequest, JsonResponse
+from django.db.models import Prefetch, Q
+from django.db.transaction import atomic, non_atomic_requests
+from django.http import FileResponse, HttpResponse, Http404, HttpRequest, HttpResponseNotModified, JsonResponse, \
+    StreamingHttpResponse
 from django.shortcuts import render
-from django.utils.decorators import classonlymethod
-from django.utils.timezone import now
+from django.utils.decorators import classonlymethod, method_decorator
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
 from django.utils.translation import ugettext
-from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.views.generic import ListView
 
+from . import catalog
+from .caching import get_cache, versioned_key
 from .forms import SubscriptionForm, PartialPayForm, ManualTransactionForm
+from .mailer import deliver_outbox, get_pool
 from .models import Event, Subscription, SubsState, Transaction
-from .notify import Notifier
+from .notify import Notifier, flush_staff_digests
 from .payment.base import get_payment, get_payment_names
-from .queue import cron, QueueAgent
-from .utils import named, prg_redirect
+from .queue import QueueAgent, single_flight_cron
+from .screening import is_suspect
+from .storage import ReceiptUploadHandler, open_stored, sendfile_location, uploaded_files
+from .utils import iter_file, named, parse_range, prg_redirect
 
 log = getLogger(__name__)
 
@@ -41,12 +52,7 @@ BLANK_PAGE = HttpResponse()
 @named('esupa-splash')
 @login_required
 def redirect_to_view_or_edit(request: HttpRequest, slug: str) -> HttpResponse:
-    try:
-        event = Event.objects.get(slug=slug)
-    except Event.DoesNotExist:
-        look_to_the_future = Event.objects.filter(starts_at__gt=now()).order_by('starts_at')
-        look_to_the_past = Event.objects.filter(starts_at__lt=now()).order_by('-starts_at')
-        event = look_to_the_future.first() or look_to_the_past.first()
+    event = catalog.event_by_slug(slug) or catalog.current_event()
     if event:
         exists = Subscription.objects.filter(event=event, user=request.user).exists()
         return prg_redirect(view.name if exists else edit.name, event.slug)
@@ -56,13 +62,13 @@ def redirect_to_view_or_edit(request: HttpRequest, slug: str) -> HttpResponse:
 
 def _get_subscription(event_slug: str, user: User) -> Subscription:
     """Takes existing subscription if available, creates a new one otherwise."""
-    try:
-        event = Event.objects.get(slug=event_slug)
-    except Event.DoesNotExist:
+    event = catalog.event_by_slug(event_slug)
+    if event is None:
         raise Http404(ugettext('Unknown event %s.') % event_slug)
     kwargs = dict(event=event, user=user)
     try:
         subscription = Subscription.objects.get(**kwargs)
+        subscription.event = event  # or else it's loaded again from the database
     except Subscription.DoesNotExist:
         subscription = Subscription(**kwargs)
     if subscription.state == SubsState.DENIED:
@@ -79,7 +85,8 @@ def view(request: HttpRequest, slug: str) -> HttpResponse:
             'sub': subscription,
             'event': subscription.event,
             'state': SubsState(subscription.state),
-            'pending_trans': subscription.transaction_set.filter(document__isnull=False, ended_at__isnull=True),
+            'pending_trans': subscription.transaction_set.defer('document').filter(
+                Q(document__isnull=False) | ~Q(document_hash=''), ended_at__isnull=True),
             'confirmed_trans': subscription.transaction_set.filter(accepted=True),
             'partial_pay_form': PartialPayForm(subscription.get_owing()),
             'pay_buttons': get_payment_names(),
@@ -111,21 +118,19 @@ def edit(request: HttpRequest, slug: str) -> HttpResponse:
     form = SubscriptionForm(data=request.POST or None, instance=subscription)
     if request.POST and form.is_valid():
         old_state = subscription.state
-        form.save()
-        s = map(str.lower, (subscription.full_name, subscription.email, subscription.document, subscription.badge))
-        b = tuple(map(str.lower, filter(bool, subscription.event.data_to_be_checked.splitlines())))
-        acceptable = True not in (t in d for d in s for t in b)
-        if not acceptable:
-            subscription.state = SubsState.VERIFYING_DATA  # Lowers the state.
-        elif subscription.paid_any:
-            if subscription.get_owing() <= 0:
-                subscription.raise_state(SubsState.CONFIRMED)
-            elif subscription.state == SubsState.CONFIRMED:
-                subscription.state = SubsState.PARTIALLY_PAID  # Lowers the state.
-        else:
-            subscription.raise_state(SubsState.ACCEPTABLE)
-        subscription.save()
-        Notifier(subscription).saved(old_state, request.build_absolute_uri)
+        with atomic():  # so the mail goes out if and only if the changes are committed
+            form.save()
+            if is_suspect(subscription):
+                subscription.state = SubsState.VERIFYING_DATA  # Lowers the state.
+            elif subscription.paid_any:
+                if subscription.get_owing() <= 0:
+                    subscription.raise_state(SubsState.CONFIRMED)
+                elif subscription.state == SubsState.CONFIRMED:
+                    subscription.state = SubsState.PARTIALLY_PAID  # Lowers the state.
+            else:
+                subscription.raise_state(SubsState.ACCEPTABLE)
+            subscription.save()
+            Notifier(subscription).saved(old_state, request.build_absolute_uri)
         return prg_redirect(view.name, slug)
     else:
         return render(request, 'esupa/edit.html', {
@@ -138,22 +143,99 @@ def edit(request: HttpRequest, slug: str) -> HttpResponse:
 @named('esupa-trans-doc')
 @login_required
 def transaction_document(request: HttpRequest, tid) -> HttpResponse:
-    trans = Transaction.objects.get(id=tid)
-    if trans is None or not trans.document:
+    """
+    Streams an attachment in chunks, honouring conditional requests and single byte ranges. With
+    ESUPA_RECEIPT_SENDFILE set to ``'X-Sendfile'`` or ``'X-Accel-Redirect'``, the front server is told to send the
+    file instead; for the latter, ESUPA_RECEIPT_ACCEL_PREFIX is its internal location for the receipt storage.
+    """
+    trans = _get_transaction(request, tid)
+    if not trans.has_document:
         raise Http404(ugettext("No such document."))
-    if not request.user.is_staff and trans.subscription.user != request.user:
-        return PermissionDenied
-    response = HttpResponse(trans.document, content_type=trans.mimetype)
+    if not trans.document_hash:  # not moved out of the database yet, see esupa_move_receipts
+        return HttpResponse(trans.document, content_type=trans.mimetype)
+    return _send_stored(request, trans.document_hash, trans.document_size, trans.mimetype,
+                        trans.filled_at or trans.created_at)
+
+
+@named('esupa-trans-thumb')
+@login_required
+def transaction_thumbnail(request: HttpRequest, tid) -> HttpResponse:
+    trans = _get_transaction(request, tid)
+    if not trans.thumbnail_hash:
+        raise Http404(ugettext("No such document."))
+    return _send_stored(request, trans.thumbnail_hash, None, 'image/jpeg', trans.filled_at or trans.created_at)
+
+
+def _get_transaction(request: HttpRequest, tid) -> Transaction:
+    trans = Transaction.objects.filter(id=tid).defer('document').first()
+    if trans is None:
+        raise Http404(ugettext("No such document."))
+    if not request.user.is_staff and trans.subscription.user_id != request.user.id:
+        raise PermissionDenied
+    return trans
+
+
+def _send_stored(request: HttpRequest, digest: str, size, mimetype: str, modified_at) -> HttpResponse:
+    modified = int(modified_at.timestamp())
+    sendfile = getattr(settings, 'ESUPA_RECEIPT_SENDFILE', None)
+    if _not_modified(request, digest, modified):
+        response = HttpResponseNotModified()
+    elif sendfile:
+        response = HttpResponse(content_type=mimetype)
+        response[sendfile] = sendfile_location(digest, sendfile)
+    else:
+        document = open_stored(digest)
+        if size is None:
+            size = document.size
+        byte_range = None
+        if 'HTTP_RANGE' in request.META and request.META.get('HTTP_IF_RANGE', quote_etag(digest)) == quote_etag(digest):
+            try:
+                byte_range = parse_range(request.META['HTTP_RANGE'], size)
+            except ValueError:
+                document.close()
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % size
+                return response
+        if byte_range is None:
+            response = FileResponse(document, content_type=mimetype)
+            response['Content-Length'] = size
+        else:
+            first, last = byte_range
+            response = StreamingHttpResponse(iter_file(document, first, last - first + 1),
+                                             status=206, content_type=mimetype)
+            response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+            response['Content-Length'] = last - first + 1
+        response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = quote_etag(digest)
+    response['Last-Modified'] = http_date(modified)
+    response['Cache-Control'] = 'private, max-age=86400'  # the content never changes for the same hash
     return response
 
 
+def _not_modified(request: HttpRequest, etag: str, modified: int) -> bool:
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)  # quoted or not, depending on the Django version
+        return quote_etag(etag) in etags or etag in etags or if_none_match.strip() == '*'
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and modified <= if_modified_since
+
+
 @named('esupa-cron')
-def cron_view(request: HttpRequest, secret) -> HttpResponse:
-    if request.user and request.user.is_staff:
-        return cron() or BLANK_PAGE
-    elif secret != getattr(settings, 'ESUPA_CRON_SECRET', None):
-        cron()
-        return BLANK_PAGE
+@non_atomic_requests  # the lease must be visible to other processes while cron runs
+def cron_view(request: HttpRequest, secret) -> JsonResponse:
+    """
+    Trigger for deployments without the esupa_worker management command running.
+
+    Only one cron runs at a time. Add ``?wait`` to wait for a run in progress to finish rather than return at once.
+    Then it sends the staff digests and whatever is due in the outbox, and includes the statistics of this
+    process's mail pool.
+    """
+    if request.user.is_staff or secret == getattr(settings, 'ESUPA_CRON_SECRET', None):
+        status = single_flight_cron(wait='wait' in request.GET)
+        flush_staff_digests()
+        mailed = deliver_outbox()
+        return JsonResponse(dict(status, mailed=mailed, mail=get_pool().stats()))
     else:
         raise SuspiciousOperation
 
@@ -161,21 +243,48 @@ def cron_view(request: HttpRequest, secret) -> HttpResponse:
 @named('esupa-pay')
 @csrf_exempt
 def paying(request: HttpRequest, code) -> HttpResponse:
+    ReceiptUploadHandler.install(request)
     resolved_view = get_payment(int(code)).class_view
     return resolved_view(request) or BLANK_PAGE
 
 
 @named('esupa-json-state')
-def json_state(_: HttpRequest, slug: str) -> JsonResponse:
-    result = JsonResponse(_json_state(slug))
+def json_state(request: HttpRequest, slug: str) -> HttpResponse:
+    """
+    Public availability, meant to be embedded anywhere. Snapshots are kept in the shared cache for
+    ESUPA_JSON_STATE_TTL seconds, or until something changes them, and clients and CDNs may keep them as long.
+    """
+    ttl = getattr(settings, 'ESUPA_JSON_STATE_TTL', 5)
+    snapshot = _json_state_snapshot(slug, ttl)
+    if _not_modified(request, snapshot['etag'], snapshot['modified']):
+        result = HttpResponseNotModified()
+    else:
+        result = JsonResponse(snapshot['state'])
+    result['ETag'] = quote_etag(snapshot['etag'])
+    result['Last-Modified'] = http_date(snapshot['modified'])
+    result['Cache-Control'] = 'public, max-age=%d' % ttl
     result['Access-Control-Allow-Origin'] = '*'
     return result
 
 
+def _json_state_snapshot(slug: str, ttl: int) -> dict:
+    cache = get_cache()
+    key = versioned_key('json-state:' + slug)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        state = _json_state(slug)
+        snapshot = {
+            'state': state,
+            'etag': md5(dumps(state, sort_keys=True).encode()).hexdigest(),
+            'modified': int(time()),
+        }
+        cache.set(key, snapshot, ttl)
+    return snapshot
+
+
 def _json_state(slug: str) -> dict:
-    try:
-        event = Event.objects.get(slug=slug)
-    except Event.DoesNotExist:
+    event = catalog.event_by_slug(slug)
+    if event is None:
         return {'exists': False, 'slug': slug}
     threshold = event.reveal_openings_under
     potentially = max(0, event.capacity - event.num_confirmed)
@@ -212,35 +321,99 @@ class EventList(EsupaListView):
     model = Event
     name = 'esupa-check-all'
 
+    def get_queryset(self):
+        return super().get_queryset().order_by('-starts_at')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(states=SubsState.choices, **kwargs)
+        Event.load_stats(context['object_list'])  # same instances the template will go through
+        return context
+
 
 class SubscriptionList(EsupaListView):
+    """
+    Staff list of an event's subscriptions, a fixed number of queries per page whatever the event size.
+
+    Pages are keyset-based: ``after`` holds the sort key and id of the last row shown. Filter with any number of
+    ``state`` values and with ``payment``, one of the keys of ``payment_filters``.
+    """
     model = Subscription
     name = 'esupa-check-event'
     _event = None
     sort_dict = {
-        'state': '-state',
-        'sid': 'id',
-        'pos': 'position',
+        'state': ('-state', 'id'),
+        'sid': ('id',),
+        'pos': ('position', 'id'),
+    }
+    payment_filters = {
+        'paid': dict(accepted=True, ended_at__isnull=False, amount__gt=0),
+        'pending': dict(filled_at__isnull=False, ended_at__isnull=True),
     }
 
     @property
     def event(self) -> Event:
         if not self._event:
-            try:
-                self._event = Event.objects.get(slug=self.args[0])
-            except Event.DoesNotExist:
+            self._event = catalog.event_by_slug(self.args[0])
+            if self._event is None:
                 raise Http404
         return self._event
 
+    @property
+    def page_size(self) -> int:
+        return getattr(settings, 'ESUPA_STAFF_PAGE_SIZE', 100)
+
     def get_queryset(self):
-        queryset = self.event.subscription_set
-        sort = self.request.GET.get('sort')
+        transactions = Transaction.objects.defer('document').order_by('id')
+        queryset = self.event.subscription_set.with_financials() \
+            .prefetch_related(Prefetch('transaction_set', queryset=transactions))
+        get = self.request.GET
+        if get.getlist('state'):
+            try:
+                queryset = queryset.filter(state__in=[int(state) for state in get.getlist('state')])
+            except ValueError:
+                raise SuspiciousOperation
+        payment = get.get('payment')
+        if payment == 'unpaid':
+            queryset = queryset.exclude(id__in=self._paying('paid'))
+        elif payment in self.payment_filters:
+            queryset = queryset.filter(id__in=self._paying(payment))
+        sort = get.get('sort')
         if sort == 'pos':
             queryset = queryset.filter(position__isnull=False)
-        return queryset.order_by(self.sort_dict.get(sort, '-state'))
+        if get.get('after'):
+            queryset = queryset.filter(self._after(sort, get['after']))
+        return queryset.order_by(*self.sort_dict.get(sort, self.sort_dict['state']))[:self.page_size + 1]
+
+    def _paying(self, payment):
+        return Transaction.objects.filter(**self.payment_filters[payment]).values('subscription_id')
+
+    @staticmethod
+    def _after(sort, cursor) -> Q:
+        try:
+            key, sid = map(int, cursor.rsplit('_', 1))
+        except ValueError:
+            raise SuspiciousOperation
+        if sort == 'sid':
+            return Q(id__gt=sid)
+        elif sort == 'pos':
+            return Q(position__gt=key) | Q(position=key, id__gt=sid)
+        else:
+            return Q(state__lt=key) | Q(state=key, id__gt=sid)
 
     def get_context_data(self, **kwargs):
-        return super().get_context_data(event=self.event, **kwargs)
+        page = list(self.object_list)
+        next_query = None
+        if len(page) > self.page_size:
+            page = page[:self.page_size]
+            last = page[-1]
+            sort = self.request.GET.get('sort')
+            key = last.id if sort == 'sid' else last.position if sort == 'pos' else last.state
+            query = self.request.GET.copy()
+            query['after'] = '%d_%d' % (key, last.id)
+            next_query = query.urlencode()
+        return super().get_context_data(event=self.event, object_list=page, subscription_list=page,
+                                        next_query=next_query, states=SubsState.choices,
+                                        sort=self.request.GET.get('sort', ''), **kwargs)
 
 
 class TransactionList(EsupaListView):
@@ -265,6 +438,11 @@ class TransactionList(EsupaListView):
             self._event = self._subscription.event
         return self._subscription
 
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        ReceiptUploadHandler.install(request)  # before anything reads the body, so CSRF is checked afterwards
+        return csrf_protect(super().dispatch)(request, *args, **kwargs)
+
     def get_queryset(self):
         return self.subscription.transaction_set.order_by('-id')
 
@@ -283,15 +461,16 @@ class TransactionList(EsupaListView):
             transaction.end(decision == 'yes')
             transaction.verifier = request.user
         else:
-            form = ManualTransactionForm(request.POST)
+            form = ManualTransactionForm(request.POST, uploaded_files(request))
             if form.is_valid():
                 transaction = Transaction(subscription_id=int(sid))
                 transaction.amount = form.cleaned_data['amount']
                 transaction.created_at = form.cleaned_data['when']
                 transaction.method = 1
-                if request.FILES:
-                    transaction.mimetype = request.FILES['attachment'].content_type or 'application/octet-stream'
-                    transaction.document = request.FILES['attachment'].read()
+                if form.cleaned_data['attachment']:
+                    attachment = form.cleaned_data['attachment']
+                    transaction.attach_document(attachment.chunks(),
+                                                attachment.content_type or 'application/octet-stream')
                 transaction.filled_at = transaction.created_at
                 transaction.verifier = request.user
                 transaction.notes = form.cleaned_data['notes']